@@ -53,14 +53,36 @@ default_hidden_query = "select c_mktsegment, sum(l_extendedprice*(1 - l_discount
 #     " Order by revenue desc, o_orderdate " \
 #     " Limit 10;"
 
-def run_unmasque():
+def run_unmasque(args):
     conn = PostgresConnection(db_name='tpch', schema='public', host='localhost', port=5432, user='tpch', password='tpch')
     ctx = UnmasqueContext(conn, default_hidden_query)
+    ctx.probe_workers = args.probe_workers
+    ctx.from_extractor_strategy = args.from_strategy
+    ctx.pkfk_csv_path = args.pkfk_csv
+    ctx.cache_dir = args.cache_dir
+    ctx.table_sizes = args.table_sizes
+    ctx.analyze_tables = args.analyze
+    ctx.sampling_method = args.sampling_method
+    ctx.sampling_seed = args.seed
+    ctx.sampling_strategy = args.sampling_strategy
+    ctx.cache_snapshots = args.cache_snapshots
+    ctx.sampler_workers = args.sampler_workers
+    ctx.minimizer_workers = args.minimizer_workers
+    ctx.join_aware_minimizer = args.join_aware_minimizer
+    ctx.minimizer_strategy = args.minimizer_strategy
+    ctx.server_side_minimizer = args.server_side_minimizer
+    ctx.minimizer_schedule = args.minimizer_schedule
 
     with Pipeline(ctx) as pipeline:
+        if args.build_sample_pyramid:
+            pipeline.build_sample_pyramid()
         pipeline.run()
 
     ctx.print_timing()
+    if ctx.pyramid_level is not None:
+        print(f"Sample pyramid level {ctx.pyramid_level[0]:g}%, sampling method {ctx.pyramid_level[1]}, seed {ctx.pyramid_level[2]}\n")
+    else:
+        print(f"Sampling method {ctx.sampling_method}, seed {ctx.sampling_seed}\n")
     print("Hidden query")
     print("===============")
     print(default_hidden_query)
@@ -74,10 +96,51 @@ if __name__ == "__main__":
                 prog='unmasque2',
                 description='TODO :D',
             )
+    argparser.add_argument('--probe-workers', type=int, default=0,
+                           help='Number of extra database sessions to run independent probes on (0 disables)')
+    argparser.add_argument('--from-strategy', choices=['linear', 'group', 'parallel'], default='linear',
+                           help='Find the core relations one table at a time, by group testing sets of tables, '
+                                'or one table at a time on --probe-workers sessions')
+    argparser.add_argument('--pkfk-csv', default=None,
+                           help='CSV file with the PK-FK relationships to use instead of the database catalog (see pkfkrelations.csv)')
+    argparser.add_argument('--cache-dir', default=None,
+                           help='Directory to cache the database metadata in, reused while the database is unchanged')
+    argparser.add_argument('--table-sizes', choices=['estimate', 'exact'], default='estimate',
+                           help='Use the planner estimates of the table sizes, or count the rows of the core relations')
+    argparser.add_argument('--analyze', action='store_true',
+                           help='ANALYZE the tables before reading the size estimates')
+    argparser.add_argument('--sampling-method', choices=['SYSTEM', 'BERNOULLI'], default='SYSTEM',
+                           help='Sample whole pages (faster) or individual rows (more uniform)')
+    argparser.add_argument('--seed', type=int, default=None,
+                           help='Seed of the sampler and the projection extractor, to reproduce a run (random by default)')
+    argparser.add_argument('--sampling-strategy', choices=['adaptive', 'pyramid', 'progressive'], default='adaptive',
+                           help='Search for the sample size, use the smallest level of the sample pyramid that gives a result, '
+                                'or add stripes of the base tables until the query has a result')
+    argparser.add_argument('--build-sample-pyramid', action='store_true',
+                           help='(Re-)build the sample pyramid of the database before running')
+    argparser.add_argument('--sampler-workers', type=int, default=0,
+                           help='Number of extra database sessions to sample the key lists without common tables on (0 disables)')
+    argparser.add_argument('--minimizer-workers', type=int, default=0,
+                           help='Number of extra database sessions to speculatively probe the next minimizer candidates on (0 disables)')
+    argparser.add_argument('--join-aware-minimizer', action='store_true',
+                           help='After a table shrinks, prune the rows of the FK-linked tables that no longer join and try their shared key values')
+    argparser.add_argument('--minimizer-strategy', choices=['reduce', 'constructive'], default='reduce',
+                           help='Reduce the sample, or first grow the instance from FK-closed rows of the fact table')
+    argparser.add_argument('--server-side-minimizer', action='store_true',
+                           help='Run the row pass of the minimizer inside the database, one call per table instead of a round-trip per probe')
+    argparser.add_argument('--minimizer-schedule', choices=['catalog', 'cost'], default='catalog',
+                           help='Minimize the core relations in catalog order, or by the rows expected to be removed per unit of estimated probe cost')
+    argparser.add_argument('--cache-snapshots', action='store_true',
+                           help='Save the sampled and minimized instances in --cache-dir, and reuse them on runs with the same query, database and --seed')
+    args = argparser.parse_args()
+    if args.cache_snapshots and args.cache_dir is None:
+        argparser.error('--cache-snapshots requires --cache-dir')
+    if args.from_strategy == 'parallel' and args.probe_workers <= 0:
+        argparser.error('--from-strategy parallel requires --probe-workers of at least 1')
 
     print(banner(), '\n')
 
-    run_unmasque()
+    run_unmasque(args)
 
 
 
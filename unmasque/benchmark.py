@@ -0,0 +1,235 @@
+import argparse
+import sys
+import time
+from loguru import logger
+from prettytable import PrettyTable
+
+from .src.connection import PostgresConnection
+from .src.context import UnmasqueContext
+from .src.correlated_sampler import KEY_TABLE_SCHEMA_PREFIX, SAMPLE_SIZE_MULTIPLIER, create_key_tables, drop_key_tables, get_base_t, \
+    key_list_groups, sample_key_list_sql, sample_key_lists
+from .src.from_extractor import from_extractor
+from .src.metadata_extractor import metadata_extractor_stage1, metadata_extractor_stage2
+from .src.pipeline import Pipeline
+from .src.probe_executor import ProbeExecutor
+
+DEFAULT_PROBE_QUERY = "SELECT n_name FROM nation WHERE n_regionkey = 1;"
+DEFAULT_PROBE_MUTATION = "UPDATE nation SET n_comment = $1;"
+DEFAULT_SAMPLER_QUERY = "SELECT c_mktsegment, COUNT(*) FROM customer, orders, lineitem " \
+    "WHERE c_custkey = o_custkey AND l_orderkey = o_orderkey GROUP BY c_mktsegment;"
+# Two groups of key lists without common tables, customer-orders and part-partsupp
+# (c_custkey = p_partkey is not a PK-FK join)
+DEFAULT_KEY_LISTS_QUERY = "SELECT c_mktsegment, COUNT(*) FROM customer, orders, part, partsupp " \
+    "WHERE c_custkey = o_custkey AND p_partkey = ps_partkey AND c_custkey = p_partkey GROUP BY c_mktsegment;"
+
+def make_connection(args) -> PostgresConnection:
+    return PostgresConnection(db_name=args.db, schema=args.schema, host=args.host, port=args.port, user=args.user, password=args.password)
+
+def bench_probes(args):
+    """
+        Probes/sec of a BEGIN + UPDATE + oracle + ROLLBACK experiment, sent
+        statement by statement on fresh cursors (the way the extractors used
+        to do it) and as a single message through `PostgresConnection.probe`.
+    """
+    conn = make_connection(args)
+    conn.connect()
+
+    def legacy_probe(value):
+        for statement, params in [('BEGIN TRANSACTION;', None), (DEFAULT_PROBE_MUTATION.replace('$1', '%s'), (value,))]:
+            cursor = conn.connection.cursor()
+            cursor.execute(statement, params)
+            cursor.close()
+
+        cursor = conn.connection.cursor()
+        cursor.execute(args.query)
+        is_empty = len(cursor.fetchall()) == 0
+        cursor.close()
+
+        cursor = conn.connection.cursor()
+        cursor.execute('ROLLBACK;')
+        cursor.close()
+        return is_empty
+
+    def batched_probe(value):
+        return conn.probe(args.query, [(DEFAULT_PROBE_MUTATION, (value,))])
+
+    t = PrettyTable()
+    t.field_names = ["Mode", "Probes", "Time", "Probes/sec"]
+    for name, probe in [('Round-trip per statement', legacy_probe), ('Single message', batched_probe)]:
+        start_time = time.time()
+        for i in range(args.probes):
+            probe(f'probe {i}')
+        elapsed = time.time() - start_time
+        t.add_row([name, args.probes, f'{round(elapsed, 2)} s', round(args.probes / elapsed, 1)])
+
+    conn.sql('ROLLBACK;', execute_only=True)
+    conn.close()
+    print(t)
+
+def bench_sampler(args):
+    """
+        Time of correlated sampling over all the key lists, with the NOT IN
+        subqueries the sampler used to issue and with the set-based statements
+        of `correlated_sampler`. Each run makes `--attempts` passes, growing
+        the sample size the way the sampler does on retries, on top of the
+        rows sampled by the previous passes. The core relations of `--query`
+        are backed up and restored the same way the pipeline does. NOT IN only
+        degrades once the planner knows how many keys have been sampled, so
+        `--analyze` gives them statistics between the passes.
+    """
+    conn = make_connection(args)
+    ctx = UnmasqueContext(conn, args.query)
+    # Both modes sample the same blocks
+    ctx.sampling_method = args.sampling_method
+    ctx.sampling_seed = args.seed
+
+    def legacy_pass(percent):
+        assert ctx.core_relations is not None
+        sizes = ctx.db_relation_sizes
+        for key_list in ctx.key_lists:
+            base_table, base_key = key_list[get_base_t(key_list, sizes)]
+            if base_table in ctx.core_relations:
+                conn.sql(f"INSERT INTO {base_table} SELECT * FROM {base_table}_restore TABLESAMPLE {ctx.sampling_method}({percent}) REPEATABLE({ctx.sampling_seed}) "
+                         f"WHERE ({base_key}) NOT IN (SELECT DISTINCT({base_key}) FROM {base_table}) LIMIT {sizes[base_table]};", execute_only=True)
+            for table, key in key_list:
+                if table != base_table and table in ctx.core_relations:
+                    conn.sql(f"INSERT INTO {table} SELECT * FROM {table}_restore WHERE {key} IN (SELECT DISTINCT({base_key}) FROM {base_table}) "
+                             f"AND {key} NOT IN (SELECT DISTINCT({key}) FROM {table}) LIMIT {sizes[table]};", execute_only=True)
+
+    def set_based_pass(percent):
+        for i, key_list in enumerate(ctx.key_lists):
+            statements = sample_key_list_sql(ctx, i, key_list, percent, ctx.db_relation_sizes)
+            if len(statements) > 0:
+                conn.sql(' '.join(statements), execute_only=True)
+
+    t = PrettyTable()
+    t.field_names = ["Mode", "Percent", "Attempts", "Runs", "Time per run", "Sampled rows"]
+    with Pipeline(ctx) as pipeline:
+        metadata_extractor_stage1(ctx)
+        from_extractor(ctx)
+        metadata_extractor_stage2(ctx)
+        assert ctx.core_relations is not None
+        pipeline.backup_tables()
+        conn.sql('COMMIT;', execute_only=True)
+
+        for name, sample_pass in [('NOT IN subqueries', legacy_pass), ('Set-based', set_based_pass)]:
+            elapsed = 0
+            sampled = 0
+            for _ in range(args.runs):
+                for table in ctx.core_relations:
+                    conn.sql(f'TRUNCATE {table};', execute_only=True)
+                create_key_tables(ctx)
+                conn.sql('COMMIT;', execute_only=True)
+
+                start_time = time.time()
+                percent = args.percent
+                for _ in range(args.attempts):
+                    sample_pass(percent)
+                    percent = min(percent * SAMPLE_SIZE_MULTIPLIER, 100)
+                    if args.analyze:
+                        conn.sql(f'ANALYZE {", ".join(ctx.core_relations)};', execute_only=True)
+                conn.sql('COMMIT;', execute_only=True)
+                elapsed += time.time() - start_time
+
+                sampled += sum(conn.row_count(f'SELECT 1 FROM {table};') for table in ctx.core_relations)
+                drop_key_tables(ctx)
+            t.add_row([name, args.percent, args.attempts, args.runs, f'{round(elapsed / args.runs, 3)} s', sampled // args.runs])
+    print(t)
+def bench_key_lists(args):
+    """
+        Time of a sampling pass over all the key lists, going through them one
+        by one and sampling the groups of key lists without common tables on
+        `--workers` sessions. The core relations of `--query` are backed up
+        and restored the same way the pipeline does.
+    """
+    conn = make_connection(args)
+    ctx = UnmasqueContext(conn, args.query)
+    ctx.sampling_method = args.sampling_method
+    ctx.sampling_seed = args.seed
+
+    t = PrettyTable()
+    t.field_names = ["Mode", "Percent", "Runs", "Time per run", "Sampled rows"]
+    with Pipeline(ctx) as pipeline:
+        metadata_extractor_stage1(ctx)
+        from_extractor(ctx)
+        metadata_extractor_stage2(ctx)
+        assert ctx.core_relations is not None
+        pipeline.backup_tables()
+        conn.sql('COMMIT;', execute_only=True)
+        print(f'Key list groups: {key_list_groups(ctx)}')
+
+        res, _ = conn.sql('SELECT pg_backend_pid();', fetch_one=True)
+        key_schema = f'{KEY_TABLE_SCHEMA_PREFIX}_{res[0]}'
+        conn.sql(f'CREATE SCHEMA {key_schema};', execute_only=True)
+        conn.sql('COMMIT;', execute_only=True)
+        try:
+            with ProbeExecutor(conn, args.workers, shared_schema=key_schema) as executor:
+                for name, pass_executor in [('Serial', None), (f'{args.workers} sessions', executor)]:
+                    elapsed = 0
+                    sampled = 0
+                    for _ in range(args.runs):
+                        conn.sql(f'TRUNCATE {", ".join(ctx.core_relations)};', execute_only=True)
+                        create_key_tables(ctx, schema=None if pass_executor is None else key_schema)
+                        conn.sql('COMMIT;', execute_only=True)
+
+                        start_time = time.time()
+                        sample_key_lists(ctx, args.percent, ctx.db_relation_sizes, executor=pass_executor)
+                        conn.sql('COMMIT;', execute_only=True)
+                        elapsed += time.time() - start_time
+
+                        sampled += sum(conn.row_count(f'SELECT 1 FROM {table};') for table in ctx.core_relations)
+                        drop_key_tables(ctx, schema=None if pass_executor is None else key_schema)
+                        conn.sql('COMMIT;', execute_only=True)
+                    t.add_row([name, args.percent, args.runs, f'{round(elapsed / args.runs, 3)} s', sampled // args.runs])
+        finally:
+            conn.sql('ROLLBACK;', execute_only=True)
+            conn.sql(f'DROP SCHEMA {key_schema} CASCADE;', execute_only=True)
+            conn.sql('COMMIT;', execute_only=True)
+    print(t)
+
+
+if __name__ == "__main__":
+    # Keep the output to the results
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING', format='{level} | {message}')
+
+    argparser = argparse.ArgumentParser(
+                prog='unmasque2-benchmark',
+                description='Micro-benchmarks for the database access paths of unmasque2',
+            )
+    argparser.add_argument('--db', default='tpch')
+    argparser.add_argument('--schema', default='public')
+    argparser.add_argument('--host', default='localhost')
+    argparser.add_argument('--port', type=int, default=5432)
+    argparser.add_argument('--user', default='tpch')
+    argparser.add_argument('--password', default='tpch')
+
+    subparsers = argparser.add_subparsers(dest='benchmark', required=True)
+
+    probes_parser = subparsers.add_parser('probes', help='Probe round-trip throughput')
+    probes_parser.add_argument('--probes', type=int, default=1000)
+    probes_parser.add_argument('--query', default=DEFAULT_PROBE_QUERY)
+    probes_parser.set_defaults(run=bench_probes)
+
+    sampler_parser = subparsers.add_parser('sampler', help='Correlated sampling time')
+    sampler_parser.add_argument('--query', default=DEFAULT_SAMPLER_QUERY)
+    sampler_parser.add_argument('--percent', type=float, default=1.0, help='TABLESAMPLE percentage of the base tables')
+    sampler_parser.add_argument('--sampling-method', choices=['SYSTEM', 'BERNOULLI'], default='SYSTEM')
+    sampler_parser.add_argument('--seed', type=int, default=0)
+    sampler_parser.add_argument('--attempts', type=int, default=2, help='Sampling passes per run, as on retries of the sampler')
+    sampler_parser.add_argument('--runs', type=int, default=3)
+    sampler_parser.add_argument('--analyze', action='store_true',
+                                help='ANALYZE the sampled relations after each pass, as autovacuum does between retries')
+    sampler_parser.set_defaults(run=bench_sampler)
+
+    key_lists_parser = subparsers.add_parser('key-lists', help='Serial and concurrent sampling of the key lists')
+    key_lists_parser.add_argument('--query', default=DEFAULT_KEY_LISTS_QUERY)
+    key_lists_parser.add_argument('--percent', type=float, default=1.0, help='TABLESAMPLE percentage of the base tables')
+    key_lists_parser.add_argument('--sampling-method', choices=['SYSTEM', 'BERNOULLI'], default='SYSTEM')
+    key_lists_parser.add_argument('--seed', type=int, default=0)
+    key_lists_parser.add_argument('--workers', type=int, default=2)
+    key_lists_parser.add_argument('--runs', type=int, default=3)
+    key_lists_parser.set_defaults(run=bench_key_lists)
+
+    args = argparser.parse_args()
+    args.run(args)
@@ -173,14 +173,14 @@ def aggregation_extractor(ctx: UnmasqueContext):
         for _ in range(alpha):
             ctx.connection.sql(f"INSERT INTO {table} (SELECT * FROM {table}_t1 LIMIT 1);", execute_only=True)
         ctx.connection.sql(f"INSERT INTO {table} (SELECT * FROM {table}_t2 LIMIT 1);", execute_only=True)
-        res, _ = ctx.connection.sql(ctx.hidden_query)
+        res, _ = ctx.connection.prepared_sql(ctx.hidden_query)
         return o1_res, o2_res, res[0], len(res)
 
     logger.info('Starting Aggregation extractor')
 
     projection_aggregations = []
 
-    hq_result, _ = ctx.connection.sql(ctx.hidden_query, fetch_one=True)
+    hq_result = ctx.connection.first_row(ctx.hidden_query)
     for i, pn_and_pd in enumerate(zip(ctx.projection_names, ctx.projection_deps)):
         proj_name, proj_deps = pn_and_pd
         proj_val = hq_result[i]
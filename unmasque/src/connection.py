@@ -1,6 +1,26 @@
-from typing import Any, Dict, Iterable, List
+import re
+from typing import Any, BinaryIO, Dict, Iterable, List, Literal, Sequence, Tuple
 from loguru import logger
 
+def strip_query(query: str) -> str:
+    """Removes the trailing semicolon so that the query can be embedded in another statement"""
+    return query.strip().rstrip(';').rstrip()
+
+PROBE_MODE = Literal['empty', 'count', 'first']
+
+def probe_query(query: str, mode: PROBE_MODE) -> str:
+    """
+        Wraps `query` into a statement returning a single row: whether its
+        result is empty, its number of rows, or its first row.
+    """
+    query = strip_query(query)
+    if mode == 'empty':
+        return f'SELECT NOT EXISTS ({query});'
+    if mode == 'count':
+        return f'SELECT COUNT(*) FROM ({query}) AS probe;'
+    return f'SELECT * FROM ({query}) AS probe LIMIT 1;'
+
+
 class IConnection:
     """
         Generic connection interface
@@ -24,10 +44,142 @@ class IConnection:
     def sql(self, query: str, params: Dict[str, Any] = {}, fetch_one=False, dict_cursor=False, execute_only=False) -> Iterable:
         pass
 
+    def prepared_sql(self, query: str, params: Sequence[Any] = (), fetch_one=False, execute_only=False) -> Iterable:
+        """
+            Same as `sql`, but the query is prepared once per session and
+            re-executed by name. Positional parameters are written as `$1`,
+            `$2`, ... in the query text.
+        """
+        pass
+
+    def statement_cache_stats(self) -> Dict[str, int]:
+        pass
+
+    # Probes
+    # The oracle checks of the extractors only need to know whether the query
+    # has a result, how many rows it has or what its first row looks like.
+    # These wrap the query server side so that postgres can stop early and only
+    # a single row crosses the wire.
+    def is_empty(self, query: str) -> bool:
+        pass
+
+    def row_count(self, query: str) -> int:
+        pass
+
+    def first_row(self, query: str) -> Tuple | None:
+        pass
+
+    def probe(self, query: str, mutations: Sequence[Tuple[str, Sequence[Any]]] = (), mode: PROBE_MODE = 'empty'):
+        pass
+
+    def commit_probe(self):
+        pass
+
+    # Contents of a whole table in the binary COPY format
+    def copy_to(self, table: str, file: BinaryIO):
+        pass
+
+    def copy_from(self, table: str, file: BinaryIO):
+        pass
+
     def table_names(self) -> List[str]:
         pass
 
 
+# Statements after which the prepared statements of a session may refer to
+# stale table definitions, and the ones ending a transaction. ROLLBACK TO
+# SAVEPOINT is told apart by its second group, as the transaction goes on.
+DDL_STATEMENTS = ('ALTER', 'CREATE', 'DROP', 'TRUNCATE')
+STATEMENT_KEYWORD = re.compile(r'(?:^|;)\s*(ALTER|CREATE|DROP|TRUNCATE|COMMIT|END|ROLLBACK|ABORT)\b(\s+(?:(?:WORK|TRANSACTION)\s+)?TO\b)?',
+                               re.IGNORECASE)
+# String literals and dollar-quoted bodies, which may contain semicolons and keywords of their own
+QUOTED_TEXT = re.compile(r"\$(\w*)\$.*?\$\1\$|'(?:[^']|'')*'", re.DOTALL)
+
+class StatementCache:
+    """
+        Book-keeping for the prepared statements of a single session.
+
+        Statements are keyed by their SQL text. Every DDL statement bumps the
+        schema version (and so does rolling back a transaction that ran DDL),
+        and a statement prepared under an older version is prepared again the
+        next time it is used. This matters because the pipeline keeps renaming
+        and recreating the tables the hidden query reads, and a prepared
+        statement keeps the parameter and result types it was planned with.
+
+        Statements are only known to be prepared once the message preparing
+        them ran. If it fails, they are forgotten and get a new name the next
+        time, as PREPARE is not undone by rolling back and some of them may
+        have been prepared after all.
+    """
+    def __init__(self):
+        self.statements: Dict[str, Tuple[str, int]] = dict()
+        self.schema_version = 0
+        self.ddl_in_transaction = False
+        self.names = 0
+        # Statements (re-)prepared by the message about to be sent
+        self.unsent: List[str] = []
+
+        self.hits = 0
+        self.misses = 0
+        self.re_prepares = 0
+
+    def observe(self, query: str):
+        """Tracks the statements sent to the session, in order, to detect schema changes"""
+        for statement in STATEMENT_KEYWORD.finditer(QUOTED_TEXT.sub("''", query)):
+            keyword = statement.group(1).upper()
+            if keyword in DDL_STATEMENTS:
+                self.schema_version += 1
+                self.ddl_in_transaction = True
+                continue
+
+            # Rolling back undoes the DDL, which is a schema change of its own.
+            # Rolling back to a savepoint may undo some of it, and the
+            # transaction goes on.
+            if self.ddl_in_transaction and keyword in ('ROLLBACK', 'ABORT'):
+                self.schema_version += 1
+            if statement.group(2) is None:
+                self.ddl_in_transaction = False
+
+    def lookup(self, query: str) -> Tuple[str, bool, bool]:
+        """Returns the statement name, and whether it has to be prepared and whether an older version has to be deallocated first"""
+        entry = self.statements.get(query)
+        if entry is None:
+            self.misses += 1
+            name = f'unmasque_stmt_{self.names}'
+            self.names += 1
+            self.statements[query] = (name, self.schema_version)
+            self.unsent.append(query)
+            return name, True, False
+
+        name, version = entry
+        if version != self.schema_version:
+            self.re_prepares += 1
+            self.statements[query] = (name, self.schema_version)
+            self.unsent.append(query)
+            return name, True, True
+
+        self.hits += 1
+        return name, False, False
+
+    def sent(self):
+        """The message preparing the statements ran"""
+        self.unsent = []
+
+    def forget_unsent(self):
+        """The message preparing the statements failed"""
+        for query in self.unsent:
+            self.statements.pop(query, None)
+        self.unsent = []
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'statements': len(self.statements),
+            'hits': self.hits,
+            'misses': self.misses,
+            're_prepares': self.re_prepares,
+        }
+
+
 import psycopg2
 from psycopg2 import extras as psycopg2_extras
 
@@ -35,21 +187,40 @@ class PostgresConnection(IConnection):
     """
         Connection interface for a postgres sql server
     """
+    def __init__(self, db_name: str, schema: str, host: str, port: int, user: str, password: str):
+        super().__init__(db_name, schema, host, port, user, password)
+        self.statement_cache = StatementCache()
+        self._cursor = None
+
+        # Statements that are sent along with the next message instead of in
+        # a round-trip of their own (the ROLLBACK that ends a probe)
+        self.pending_sql: List[str] = []
+
     def connect(self):
         self.connection = psycopg2.connect(self._make_connection_str())
+        self._cursor = None
+        self.pending_sql = []
+        # Prepared statements do not outlive the session
+        self.statement_cache = StatementCache()
 
     def close(self):
         if self.connection is not None:
+            # Make sure a deferred COMMIT is not lost
+            if self.pending_sql:
+                self._execute('')
             self.connection.close()
             self.connection = None
+            self._cursor = None
 
 
     def sql(self, query: str, params: Dict[str, Any] = {}, fetch_one=False, dict_cursor=False, execute_only=False):
         if self.connection is None:
             self.connect()
 
+        self.statement_cache.observe(query)
+
         cursor = self.cursor() if not dict_cursor else self.dict_cursor()
-        cursor.execute(query, params)
+        self._send(cursor, self._take_pending_sql() + query, params)
 
         result = None
         description = None
@@ -58,12 +229,90 @@ class PostgresConnection(IConnection):
             result = cursor.fetchall() if not fetch_one else cursor.fetchone()
             description = cursor.description
 
-        cursor.close()
+        if dict_cursor:
+            cursor.close()
         return result, description
 
 
+    def prepared_sql(self, query: str, params: Sequence[Any] = (), fetch_one=False, execute_only=False):
+        if self.connection is None:
+            self.connect()
+
+        return self.sql(self._prepared_statement(query, params), None, fetch_one=fetch_one, execute_only=execute_only)
+
+    def statement_cache_stats(self) -> Dict[str, int]:
+        return self.statement_cache.stats()
+
+    def is_empty(self, query: str) -> bool:
+        res, _ = self.prepared_sql(probe_query(query, 'empty'), fetch_one=True)
+        return res[0]
+
+    def row_count(self, query: str) -> int:
+        res, _ = self.prepared_sql(probe_query(query, 'count'), fetch_one=True)
+        return res[0]
+
+    def first_row(self, query: str) -> Tuple | None:
+        res, _ = self.prepared_sql(probe_query(query, 'first'), fetch_one=True)
+        return res
+
+    def probe(self, query: str, mutations: Sequence[Tuple[str, Sequence[Any]]] = (), mode: PROBE_MODE = 'empty'):
+        """
+            Runs a whole experiment, i.e. `BEGIN`, the mutations and the
+            oracle check on `query`, as a single message and returns the
+            outcome of the check (see `probe_query` for the modes).
+
+            Mutations are `(statement, params)` pairs. Statements with
+            parameters go through the prepared statement cache, the others
+            (e.g. DDL) are sent as they are.
+
+            The transaction is left open and is rolled back as part of the
+            next message sent on this connection. Call `commit_probe` right
+            after the probe to keep its changes instead.
+        """
+        if self.connection is None:
+            self.connect()
+
+        statements = ['BEGIN TRANSACTION;']
+        for statement, params in mutations:
+            if len(params) == 0:
+                self.statement_cache.observe(statement)
+                statements.append(statement)
+            else:
+                statements.append(self._prepared_statement(statement, params))
+        statements.append(self._prepared_statement(probe_query(query, mode), ()))
+
+        cursor = self.cursor()
+        self._send(cursor, self._take_pending_sql() + ' '.join(statements))
+        res = cursor.fetchone()
+
+        self._defer('ROLLBACK;')
+        return res if mode == 'first' else res[0]
+
+    def commit_probe(self):
+        """Keeps the changes made by the last probe"""
+        if self.pending_sql and self.pending_sql[-1] == 'ROLLBACK;':
+            self.pending_sql.pop()
+        self._defer('COMMIT;')
+
+    def copy_to(self, table: str, file: BinaryIO):
+        if self.connection is None:
+            self.connect()
+        # COPY cannot share a message with other statements
+        if self.pending_sql:
+            self._execute('')
+        self.cursor().copy_expert(f'COPY {table} TO STDOUT (FORMAT binary);', file)
+
+    def copy_from(self, table: str, file: BinaryIO):
+        if self.connection is None:
+            self.connect()
+        if self.pending_sql:
+            self._execute('')
+        self.cursor().copy_expert(f'COPY {table} FROM STDIN (FORMAT binary);', file)
+
     def table_names(self) -> List[str]:
-        res, _ = self.sql(f"SELECT table_name FROM information_schema.tables WHERE table_schema = '{self.schema}'")
+        res, _ = self.sql("SELECT c.relname FROM pg_catalog.pg_class c JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace "
+                          "WHERE n.nspname = %(schema)s AND c.relkind IN ('r', 'p') AND NOT c.relispartition ORDER BY c.oid;",
+                          {'schema': self.schema})
         if res is None:
             logger.error('Failed to fetch table names.')
             raise RuntimeError('Failed to fetch table names.')
@@ -71,11 +320,60 @@ class PostgresConnection(IConnection):
         return [x[0] for x in res]
 
 
+    def _send(self, cursor, message: str, params: Dict[str, Any] | None = None):
+        """
+            Executes a message. If it fails, rolls back and forgets the
+            statements it was to prepare, so that they are prepared again
+        """
+        try:
+            cursor.execute(message, params)
+        except psycopg2.Error:
+            self.statement_cache.forget_unsent()
+            self.statement_cache.observe('ROLLBACK;')
+            self.connection.rollback()
+            raise
+        self.statement_cache.sent()
+
+    def _execute(self, query: str):
+        """Executes a statement without any parameter substitution"""
+        self.cursor().execute(self._take_pending_sql() + query)
+
+    def _defer(self, statement: str):
+        self.statement_cache.observe(statement)
+        self.pending_sql.append(statement)
+
+    def _take_pending_sql(self) -> str:
+        if not self.pending_sql:
+            return ''
+        pending = ' '.join(self.pending_sql) + ' '
+        self.pending_sql = []
+        return pending
+
+    def _prepared_statement(self, query: str, params: Sequence[Any]) -> str:
+        """Returns the text that (re-)prepares the query if needed and executes it with the given parameters"""
+        query = strip_query(query)
+        name, needs_prepare, needs_deallocate = self.statement_cache.lookup(query)
+
+        statement = ''
+        if needs_deallocate:
+            statement += f'DEALLOCATE {name}; '
+        if needs_prepare:
+            statement += f'PREPARE {name} AS {query}; '
+
+        if len(params) == 0:
+            return statement + f'EXECUTE {name};'
+
+        placeholders = ', '.join(['%s'] * len(params))
+        return statement + self.cursor().mogrify(f'EXECUTE {name} ({placeholders});', tuple(params)).decode()
+
     def _make_connection_str(self):
         return f"dbname={self.db_name} user={self.user} password={self.password} host={self.host} port={self.port}" 
 
     def cursor(self):
-        return self.connection.cursor()
+        # A single cursor is kept for the lifetime of the session
+        if self._cursor is None or self._cursor.closed:
+            self._cursor = self.connection.cursor()
+        return self._cursor
 
     def dict_cursor(self):
         return self.connection.cursor(cursor_factory=psycopg2_extras.DictCursor)
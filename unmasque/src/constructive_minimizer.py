@@ -0,0 +1,68 @@
+import random
+from typing import List, Tuple
+from loguru import logger
+from .context import UnmasqueContext
+from .minimizer import key_list_tree
+
+SEEDS_PER_PROBE = 16        # Seed rows whose closures are tried together
+SEED_BUDGET = 256           # Seed rows tried before falling back to the reducing minimizer
+
+def get_seed_table(ctx: UnmasqueContext) -> str:
+    """
+        Returns the fact table, whose rows reference a single row of the other
+        core relations: the one with the most foreign keys to them and the
+        least references from them
+    """
+    assert ctx.core_relations is not None
+    score = {table: 0 for table in ctx.core_relations}
+    for key_list in ctx.key_lists:
+        clique = [(table, key) for table, key in key_list if table in ctx.core_relations]
+        if len(clique) < 2:
+            continue
+        for table, key in clique:
+            score[table] += -1 if ctx.pk_dict.get(table) == key else 1
+    return max(ctx.core_relations, key=lambda table: (score[table], ctx.db_relation_sizes.get(table, 0)))
+
+def closure_mutations(ctx: UnmasqueContext, seed_table: str, seeds: List[str]) -> List[Tuple[str, Tuple]]:
+    """
+        Deletions leaving only the seed rows and the rows of the other core
+        relations they join with through the key lists. The deletions run in
+        breadth-first order, so each hop only follows the rows kept by the
+        previous ones.
+    """
+    mutations: List[Tuple[str, Tuple]] = [(f'DELETE FROM {seed_table} WHERE ctid <> ALL($1::tid[]);', ('{' + ','.join(f'"{ctid}"' for ctid in seeds) + '}',))]
+    for child, child_key, parent, parent_key in key_list_tree(ctx, seed_table):
+        mutations.append((f'DELETE FROM {child} WHERE NOT EXISTS (SELECT 1 FROM {parent} WHERE {parent}.{parent_key} = {child}.{child_key});', ()))
+    return mutations
+
+def constructive_minimizer(ctx: UnmasqueContext) -> bool:
+    """
+        Grows the instance from single rows of the fact table instead of
+        reducing the sample: a batch of seed rows and their FK closure is kept
+        if the hidden query has a result on it. The minimizer then only has a
+        handful of rows left to go through. Leaves the instance untouched and
+        returns False if no seed works within the budget.
+    """
+    if ctx.core_relations is None:
+        raise RuntimeError('Cannot run minimizer without extracting metadata.')
+
+    logger.info('Starting constructive minimizer')
+
+    seed_table = get_seed_table(ctx)
+    ctids, _ = ctx.connection.sql(f'SELECT ctid FROM {seed_table};')
+    seeds = [ctid[0] for ctid in ctids]
+    random.Random(ctx.sampling_seed).shuffle(seeds)
+    seeds = seeds[:SEED_BUDGET]
+
+    for probes, start in enumerate(range(0, len(seeds), SEEDS_PER_PROBE), start=1):
+        batch = seeds[start:start + SEEDS_PER_PROBE]
+        if ctx.connection.probe(ctx.hidden_query, closure_mutations(ctx, seed_table, batch)):
+            continue
+
+        ctx.connection.commit_probe()
+        sizes = {table: ctx.connection.row_count(f'SELECT 1 FROM {table};') for table in ctx.core_relations}
+        logger.info(f'Finishing constructive minimizer with {len(batch)} {seed_table} seeds after {probes} probes: {sizes}')
+        return True
+
+    logger.info(f'Finishing constructive minimizer without a result from {len(seeds)} {seed_table} seeds')
+    return False
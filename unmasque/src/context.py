@@ -1,4 +1,4 @@
-from typing import Dict, List, Tuple
+from typing import Any, Dict, List, Literal, Tuple
 from .connection import IConnection
 from prettytable import PrettyTable
 
@@ -7,6 +7,29 @@ class UnmasqueContext:
         self.connection = connection 
         self.hidden_query = hidden_query
 
+        # Options
+        self.probe_workers: int = 0     # Number of extra sessions to run independent probes on, 0 to disable
+        self.from_extractor_strategy: Literal['linear', 'group', 'parallel'] = 'linear'
+        self.pkfk_csv_path: str | None = None     # Read the PK-FK relationships from this file instead of the catalog
+        self.cache_dir: str | None = None         # Directory for the metadata cache, None to disable
+        self.table_sizes: Literal['estimate', 'exact'] = 'estimate'  # Exact counts are only taken for the core relations
+        self.analyze_tables: bool = False         # ANALYZE before reading the size estimates
+        self.sampling_method: Literal['SYSTEM', 'BERNOULLI'] = 'SYSTEM'   # TABLESAMPLE method, SYSTEM samples whole pages
+        self.sampling_seed: int | None = None     # Seed of the sampler and the projection extractor, random if None
+        self.sampling_strategy: Literal['adaptive', 'pyramid', 'progressive'] = 'adaptive'   # Pyramid falls back to adaptive sampling
+        self.sampler_workers: int = 0             # Number of extra sessions to sample the groups of key lists without common tables on, 0 to disable
+        self.cache_snapshots: bool = False        # Cache the sampled and minimized instances in cache_dir
+        self.minimizer_workers: int = 0           # Number of extra sessions to probe minimizer candidates on, 0 to disable
+        self.join_aware_minimizer: bool = False   # Prune the rows that no longer join after a table shrinks
+        self.minimizer_strategy: Literal['reduce', 'constructive'] = 'reduce'   # Constructive falls back to reducing the whole sample
+        self.server_side_minimizer: bool = False  # Run the row pass of the minimizer in a PL/pgSQL function
+        self.minimizer_schedule: Literal['catalog', 'cost'] = 'catalog'    # Minimize the tables with the most rows expected to be removed per unit of probe cost first
+
+        # Set by the pipeline while a probe executor is running
+        self.probe_executor = None
+        # Set by the pipeline before sampling, so that they do not depend on what the sampler picks
+        self.snapshot_keys: Dict[str, str] = dict()
+
         # Done flags
         self.metadata_s1_extraction_done = False
         self.metadata_s2_extraction_done = False
@@ -43,13 +66,20 @@ class UnmasqueContext:
         self.key_lists: List[List[Tuple[str, str]]] = []
         self.db_attribs_types: Dict[str, Dict[str, str]] = dict()
         self.db_attribs_max_length: Dict[str, Dict[str, int]] = dict()
+        self.metadata_fingerprint: str | None = None
+        self.cached_metadata: Dict[str, Any] | None = None
 
         # From Extractor 
         self.core_relations: List[str] | None = None
+        self.from_probe_latency: Dict[str, float] = dict()
+
+        # Sampler
+        self.pyramid_level: Tuple[float, str, int] | None = None     # Percent, TABLESAMPLE method and seed of the sample pyramid level used
 
         # Minimizer
         self.table_attributes_map: Dict[str, List[str]] = dict()
         self.minimized_attributes: Dict[str, List[str]] = dict()
+        self.minimizer_probes: int = 0
 
         # Join Extractor
         self.join_graph: List[List[Tuple[str, str]]] = []
@@ -91,14 +121,17 @@ class UnmasqueContext:
         self.db_attribs_types = db_attribs_types
         self.db_attribs_max_length = db_attribs_max_length
 
-    def set_from_extractor(self, core_relations):
+    def set_from_extractor(self, core_relations, from_probe_latency=None):
         self.from_extractor_done = True
         self.core_relations = core_relations
+        if from_probe_latency is not None:
+            self.from_probe_latency = from_probe_latency
 
-    def set_minimizer(self, table_attrib_map, minimized_attributes):
+    def set_minimizer(self, table_attrib_map, minimized_attributes, minimizer_probes=0):
         self.minimzer_done = True
         self.table_attributes_map = table_attrib_map
         self.minimized_attributes = minimized_attributes
+        self.minimizer_probes = minimizer_probes
 
     def set_join_extractor(self, join_graph: List[List[Tuple[str, str]]]):
         self.join_extractor_done = True
@@ -1,70 +1,219 @@
 import copy
+import random
+import time
+from typing import Dict, List, Set, Tuple
 from loguru import logger
 from .context import UnmasqueContext
+from .probe_executor import ProbeExecutor
 
 MAX_SAMPLING_ATTEMPTS = 100
-SAMPLE_SIZE_MULTIPLIER = 10
+SAMPLE_SIZE_MULTIPLIER = 2
 INITIAL_SAMPLE_SIZE_PERCENT = 0.16
 
+# Bisection stops once the failing and succeeding rates are within this
+# fraction of each other
+SAMPLE_SIZE_TOLERANCE = 0.1
+MAX_BISECTION_STEPS = 8
+SAMPLER_SAVEPOINT = 'unmasque_sampler'
+
+# The progressive sampler adds the base tables one stripe of pages at a time,
+# in an order shuffled with the seed
+PROGRESSIVE_STRIPES = 1000
+
 DEBUG_SAMPLER = True
 
+# Temporary tables holding the sampled keys of each key list. They are private
+# to the session, so concurrent runs on the same database do not clash.
+KEY_TABLE_PREFIX = 'unmasque_keys'
+# Schema of the key tables when the key lists are sampled on other sessions,
+# which cannot see temporary tables. Suffixed with the backend pid of the
+# sampler's session for the same reason.
+KEY_TABLE_SCHEMA_PREFIX = 'unmasque_sampler'
+
+# Names of the tables rows are sampled into and from, the copies of the core
+# relations and their backups by default
+SAMPLE_TARGET = '{table}'
+SAMPLE_SOURCE = '{table}_restore'
+
+def get_base_t(key_list, sizes):
+    max_cs = 0
+    base_t = 0
+    for i in range(0, len(key_list)):
+        if max_cs < sizes[key_list[i][0]]:
+            max_cs = sizes[key_list[i][0]]
+            base_t = i
+    return base_t
+
+def key_table(i: int) -> str:
+    return f'{KEY_TABLE_PREFIX}_{i}'
+
+def get_dependents(ctx: UnmasqueContext, key_list: List[Tuple[str, str]], base_table: str) -> Dict[str, List[str]]:
+    """Core relations of the key list sampled through the base table, with their key attributes"""
+    assert ctx.core_relations is not None
+    # A table can join the clique through more than one attribute
+    dependents: Dict[str, List[str]] = dict()
+    for table, key in key_list:
+        if table != base_table and table in ctx.core_relations:
+            dependents.setdefault(table, []).append(key)
+    return dependents
+
+def key_lists_with_dependents(ctx: UnmasqueContext):
+    for i, key_list in enumerate(ctx.key_lists):
+        base_table, base_key = key_list[get_base_t(key_list, ctx.db_relation_sizes)]
+        if len(get_dependents(ctx, key_list, base_table)) > 0:
+            yield i, base_table, base_key
+
+def create_key_tables(ctx: UnmasqueContext, target: str = SAMPLE_TARGET, schema: str | None = None):
+    """
+        Creates the key table of every key list with dependents, holding the
+        distinct keys of its base table (i.e. of the rows sampled so far if it
+        is a core relation, of the whole table otherwise). The tables are
+        temporary, or unlogged tables in `schema` if given, for other sessions
+        that have it on their search path.
+    """
+    for i, base_table, base_key in key_lists_with_dependents(ctx):
+        table = key_table(i) if schema is None else f'{schema}.{key_table(i)}'
+        ctx.connection.sql(f'DROP TABLE IF EXISTS {table};', execute_only=True)
+        ctx.connection.sql(f'CREATE {"TEMPORARY" if schema is None else "UNLOGGED"} TABLE {table} AS '
+                           f'SELECT DISTINCT {base_key} AS key FROM {target.format(table=base_table)} WHERE {base_key} IS NOT NULL;', execute_only=True)
+        ctx.connection.sql(f'ANALYZE {table};', execute_only=True)
+
+def drop_key_tables(ctx: UnmasqueContext, schema: str | None = None):
+    for i, _, _ in key_lists_with_dependents(ctx):
+        ctx.connection.sql(f'DROP TABLE IF EXISTS {key_table(i) if schema is None else f"{schema}.{key_table(i)}"};', execute_only=True)
+
+def insert_sql(ctx: UnmasqueContext, table: str, select: str, target: str = SAMPLE_TARGET) -> str:
+    """
+        Builds a statement inserting the rows of `select` into the (copy of
+        the) core relation `table`, which also adds their keys to the key
+        tables of the key lists `table` is the base table of.
+    """
+    keys = [(i, base_key) for i, base_table, base_key in key_lists_with_dependents(ctx) if base_table == table]
+
+    if len(keys) == 0:
+        return f'INSERT INTO {target.format(table=table)} {select};'
+
+    ctes = [f'new_rows AS (INSERT INTO {target.format(table=table)} {select} RETURNING {", ".join(dict.fromkeys(key for _, key in keys))})']
+    for i, key in keys:
+        ctes.append(f"""new_keys_{i} AS (
+                INSERT INTO {key_table(i)} SELECT DISTINCT {key} FROM new_rows AS n
+                WHERE n.{key} IS NOT NULL AND NOT EXISTS (SELECT 1 FROM {key_table(i)} AS k WHERE k.key = n.{key})
+            )""")
+    # Data modifying CTEs run to completion even when they are not referenced
+    return f'WITH {", ".join(ctes)} SELECT;'
+
+def sample_key_list_sql(ctx: UnmasqueContext, i: int, key_list: List[Tuple[str, str]], sample_size_percent: float, sizes: Dict[str, int],
+                        target: str = SAMPLE_TARGET, source: str = SAMPLE_SOURCE, base_condition: str | None = None) -> List[str]:
+    """
+        Builds the statements sampling the base table of the key list and then
+        all the rows of the other tables joining with the sampled keys. The
+        keys are kept in an unindexed table (analyzed, so that the planner
+        knows how many there are, and hash joins with it), and the rows
+        sampled earlier are skipped with anti-joins instead of NOT IN
+        subqueries, which fall back to a scan of the subquery per row once
+        the keys outgrow work_mem. The base table is sampled
+        with a fixed seed, so a sample is a subset of every larger one. With
+        `base_condition`, the rows of the base table it holds for are added
+        instead.
+    """
+    assert ctx.core_relations is not None
+    assert ctx.sampling_seed is not None
+    base_table, base_key = key_list[get_base_t(key_list, sizes)]
+    dependents = get_dependents(ctx, key_list, base_table)
+
+    statements = []
+    if base_table in ctx.core_relations:
+        # Without dependents there is no key table to look the sampled keys up in
+        sampled_keys = key_table(i) if len(dependents) > 0 else f'(SELECT DISTINCT {base_key} AS key FROM {target.format(table=base_table)})'
+        sample = f'TABLESAMPLE {ctx.sampling_method}({sample_size_percent}) REPEATABLE({ctx.sampling_seed}) WHERE' \
+            if base_condition is None else f'WHERE {base_condition} AND'
+        statements.append(insert_sql(ctx, base_table, f"""
+            SELECT * FROM {source.format(table=base_table)} AS r {sample} r.{base_key} IS NOT NULL AND NOT EXISTS (SELECT 1 FROM {sampled_keys} AS k WHERE k.key = r.{base_key}) LIMIT {sizes[base_table]}""", target))
+
+    if len(dependents) == 0:
+        return statements
+
+    statements.append(f'ANALYZE {key_table(i)};')
+    for table, table_keys in dependents.items():
+        conditions = ' OR '.join(
+            f'(r.{key} IN (SELECT key FROM {key_table(i)}) AND NOT EXISTS (SELECT 1 FROM {target.format(table=table)} AS t WHERE t.{key} = r.{key}))'
+            for key in table_keys
+        )
+        statements.append(insert_sql(ctx, table, f"""
+            SELECT * FROM {source.format(table=table)} AS r WHERE {conditions} LIMIT {sizes[table]}""", target))
+
+    return statements
+
+def key_list_groups(ctx: UnmasqueContext) -> List[List[int]]:
+    """
+        Groups the key lists that write to a common core relation (and with
+        it, to the key tables of the key lists it is the base table of). The
+        key lists of a group are kept in order, and different groups write to
+        disjoint tables, so sampling the groups concurrently gives the same
+        sample as going through the key lists one by one. The groups with the
+        largest base tables come first, so that the longest one starts first.
+    """
+    assert ctx.core_relations is not None
+    groups: List[Tuple[Set[str], List[int]]] = []
+    for i, key_list in enumerate(ctx.key_lists):
+        tables = set(table for table, _ in key_list if table in ctx.core_relations)
+        connected = [group for group in groups if group[0] & tables]
+        groups = [group for group in groups if not group[0] & tables]
+        groups.append((tables.union(*(group[0] for group in connected)), sorted(sum((group[1] for group in connected), [i]))))
+
+    def work(key_lists: List[int]) -> int:
+        return sum(ctx.db_relation_sizes[ctx.key_lists[i][get_base_t(ctx.key_lists[i], ctx.db_relation_sizes)][0]] for i in key_lists)
+    return sorted((key_lists for _, key_lists in groups), key=work, reverse=True)
+
+def sample_key_lists(ctx: UnmasqueContext, sample_size_percent: float, sizes: Dict[str, int], base_conditions: Dict[str, str] | None = None,
+                     executor: ProbeExecutor | None = None):
+    """
+        Samples all the key lists, with a round-trip per key list, or with a
+        committed transaction per group of key lists on the sessions of
+        `executor`. `base_conditions` select the rows to add from the base
+        tables instead of sampling them.
+    """
+    def key_list_sql(i: int) -> List[str]:
+        key_list = ctx.key_lists[i]
+        base_condition = None
+        if base_conditions is not None:
+            base_condition = base_conditions.get(key_list[get_base_t(key_list, sizes)][0], 'false')
+        return sample_key_list_sql(ctx, i, key_list, sample_size_percent, sizes, base_condition=base_condition)
+
+    if executor is None:
+        for i in range(len(ctx.key_lists)):
+            statements = key_list_sql(i)
+            if len(statements) > 0:
+                ctx.connection.sql(' '.join(statements), execute_only=True)
+        return
+
+    futures = [executor.submit_transaction([statement for i in group for statement in key_list_sql(i)]) for group in key_list_groups(ctx)]
+    for future in futures:
+        future.result()
+
 def correlated_sampler(ctx: UnmasqueContext) -> bool:
     if ctx.core_relations is None:
         raise RuntimeError("Cannot do sampling without extraction of metadata")
 
     def empty_qurey_result() -> bool:
-        res, _ = ctx.connection.sql(ctx.hidden_query)
-        return len(res) == 0
-
-    def get_base_t(key_list, sizes):
-        max_cs = 0
-        base_t = 0
-        for i in range(0, len(key_list)):
-            if max_cs < sizes[key_list[i][0]]:
-                max_cs = sizes[key_list[i][0]]
-                base_t = i
-        return base_t
+        return ctx.connection.is_empty(ctx.hidden_query)
 
     def do_for_key_lists(sample_size_percent, sizes):
         if ctx.core_relations is None:
             raise RuntimeError("Cannot do sampling without extraction of metadata")
 
-        for key_list in ctx.key_lists:
-            base_t = get_base_t(key_list, sizes)
-
-            # Sample base table
-            base_table = key_list[base_t][0]
-            base_key = key_list[base_t][1]
-            if base_table in ctx.core_relations:
-                limit_row = sizes[base_table]
-                ctx.connection.sql(f"""
-                                   INSERT INTO {base_table} SELECT * FROM {base_table}_restore 
-                                                            TABLESAMPLE SYSTEM({sample_size_percent}) 
-                                                            WHERE ({base_key}) NOT IN (SELECT DISTINCT({base_key}) FROM {base_table}) LIMIT {limit_row};
-                                   """, execute_only=True)
-                if DEBUG_SAMPLER:
-                    res, _ = ctx.connection.sql(f'SELECT COUNT(*) FROM {base_table};', fetch_one=True)
-                    logger.debug(f'Sampled {res[0]} items from {base_table}')
-
-            # sample remaining tables from key_list using the sampled base table
-            for i in range(0, len(key_list)):
-                tabname2 = key_list[i][0]
-                key2 = key_list[i][1]
-
-                # if tabname2 in not_sampled_tables:
-                if tabname2 != base_table and tabname2 in ctx.core_relations:
-                    limit_row = sizes[tabname2]
-                    ctx.connection.sql(f"""
-                                       INSERT INTO {tabname2} SELECT * FROM {tabname2}_restore WHERE {key2} IN (SELECT DISTINCT({base_key}) FROM {base_table}) AND {key2} NOT IN (SELECT DISTINCT({key2}) FROM {tabname2}) LIMIT {limit_row};
-                                       """,execute_only=True)
-                    if DEBUG_SAMPLER:
-                        res, _ = ctx.connection.sql(f'SELECT COUNT(*) FROM {tabname2};', fetch_one=True)
-                        logger.debug(f'Sampled {res[0]} items from {tabname2}')
+        sample_key_lists(ctx, sample_size_percent, sizes, executor=executor)
+        if DEBUG_SAMPLER:
+            for table in ctx.core_relations:
+                res, _ = ctx.connection.sql(f'SELECT COUNT(*) FROM {table};', fetch_one=True)
+                logger.debug(f'Sampled {res[0]} items from {table}')
 
     def do_for_empty_key_lists(sample_size_percent, not_sampled_tables):
         if len(ctx.key_lists) == 0:
             for table in not_sampled_tables:
-                ctx.connection.sql(f"INSERT INTO {table} SELECT * FROM {table}_restore TABLESAMPLE SYSTEM({sample_size_percent});", execute_only=True)
+                # Nothing to join with, so resample the table instead of adding to it
+                ctx.connection.sql(f"DELETE FROM {table};", execute_only=True)
+                ctx.connection.sql(f"INSERT INTO {table} SELECT * FROM {table}_restore TABLESAMPLE {ctx.sampling_method}({sample_size_percent}) REPEATABLE({ctx.sampling_seed});", execute_only=True)
                 if DEBUG_SAMPLER:
                     res, _ = ctx.connection.sql(f'SELECT COUNT(*) FROM {table};', fetch_one=True)
                     logger.debug(f'Sampled {res[0]} items from {table}')
@@ -73,40 +222,225 @@ def correlated_sampler(ctx: UnmasqueContext) -> bool:
         if ctx.core_relations is None:
             raise RuntimeError("Cannot do sampling without extraction of metadata")
 
+        start_time = time.time()
         do_for_key_lists(sample_size_percent, sizes)
         not_sampled_tables = copy.deepcopy(ctx.core_relations)
         do_for_empty_key_lists(sample_size_percent, not_sampled_tables)
+        sampling_time = time.time() - start_time
 
-        if empty_qurey_result():
-            return False
+        start_time = time.time()
+        success = not empty_qurey_result()
+        probe_time = time.time() - start_time
+
+        sample_sizes = {table: ctx.connection.row_count(f'SELECT 1 FROM {table};') for table in ctx.core_relations}
+        logger.info(f'Sampled {sample_size_percent:.4g}%: {sample_sizes}, '
+                    f'sampling {round(sampling_time, 3)} s, probe {round(probe_time, 3)} s, '
+                    f'result {"non-empty" if success else "empty"}')
+        return success
+
+    def savepoint():
+        """
+            Keeps the current sample to go back to. The other sessions commit
+            what they sample, so with them the sample is copied into the key
+            table schema instead.
+        """
+        assert ctx.core_relations is not None
+        if executor is None:
+            ctx.connection.sql(f'SAVEPOINT {SAMPLER_SAVEPOINT};', execute_only=True)
+            return
+
+        for table in ctx.core_relations:
+            # Suffixed, as the schema is ahead of the working schema on the search path of the other sessions
+            ctx.connection.sql(f'DROP TABLE IF EXISTS {key_schema}.{table}_{SAMPLER_SAVEPOINT};', execute_only=True)
+            ctx.connection.sql(f'CREATE UNLOGGED TABLE {key_schema}.{table}_{SAMPLER_SAVEPOINT} AS SELECT * FROM {table};', execute_only=True)
+        ctx.connection.sql('COMMIT;', execute_only=True)
+
+    def rollback_to_savepoint():
+        assert ctx.core_relations is not None
+        if executor is None:
+            ctx.connection.sql(f'ROLLBACK TO SAVEPOINT {SAMPLER_SAVEPOINT};', execute_only=True)
+            return
+
+        ctx.connection.sql(f'TRUNCATE {", ".join(ctx.core_relations)};', execute_only=True)
+        for table in ctx.core_relations:
+            ctx.connection.sql(f'INSERT INTO {table} SELECT * FROM {key_schema}.{table}_{SAMPLER_SAVEPOINT};', execute_only=True)
+        # The key tables hold the keys of the sampled rows of the base tables
+        create_key_tables(ctx, schema=key_schema)
+        ctx.connection.sql('COMMIT;', execute_only=True)
 
-        # Update post sampled sizes
+    def update_sizes():
+        assert ctx.core_relations is not None
         for table in ctx.core_relations:
             res, _ = ctx.connection.sql(f'SELECT COUNT(*) FROM {table};', fetch_one=True)
-            size = res[0]
+            ctx.db_relation_sizes[table] = res[0]
+
+    def search() -> bool:
+        """Finds the smallest sampling rate for which the hidden query has a result"""
+        assert ctx.core_relations is not None
+
+        # The savepoint always holds the largest sample known to give an empty result
+        savepoint()
+        failed_percent = 0.0
+        succeeded_percent = None
+        sample_size_percent = INITIAL_SAMPLE_SIZE_PERCENT
+        attempts_left = MAX_SAMPLING_ATTEMPTS
+        while attempts_left > 0:
+            logger.info(f'Starting sampling attempt {MAX_SAMPLING_ATTEMPTS - attempts_left}')
+            if sample(sample_size_percent, ctx.db_relation_sizes):
+                succeeded_percent = sample_size_percent
+                break
+
+            logger.warning(f'Sampling attempt {MAX_SAMPLING_ATTEMPTS - attempts_left} failed.')
+            if sample_size_percent >= 100:
+                break
+            failed_percent = sample_size_percent
+            savepoint()
+            sample_size_percent = min(sample_size_percent * SAMPLE_SIZE_MULTIPLIER, 100)
+            attempts_left -= 1
+
+        if succeeded_percent is None:
+            logger.error(f'Failed correlated sampling completely. Instead using the whole DB. All subsequent stages may be slow.')
+            for table in ctx.core_relations:
+                ctx.connection.sql(f'DELETE FROM {table};', execute_only=True)
+                ctx.connection.sql(f'INSERT INTO {table} SELECT * FROM {table}_restore;',execute_only=True)
+            return False
 
-            ctx.db_relation_sizes[table] = size
+        # Bisect between the largest failing and the smallest succeeding rate
+        bisection_steps = 0
+        while succeeded_percent - failed_percent > succeeded_percent * SAMPLE_SIZE_TOLERANCE and bisection_steps < MAX_BISECTION_STEPS:
+            bisection_steps += 1
+            sample_size_percent = (failed_percent + succeeded_percent) / 2
+            rollback_to_savepoint()
+            logger.info(f'Bisecting between {failed_percent:.4g}% and {succeeded_percent:.4g}%')
+            if sample(sample_size_percent, ctx.db_relation_sizes):
+                succeeded_percent = sample_size_percent
+            else:
+                failed_percent = sample_size_percent
+                savepoint()
 
+        if sample_size_percent != succeeded_percent:
+            # The last bisection step failed, so get back to the smallest succeeding sample
+            if not sample(succeeded_percent, ctx.db_relation_sizes):
+                logger.error('Resampling at a succeeding rate gave an empty result, the hidden query may not be monotonic')
+                raise RuntimeError('Resampling at a succeeding rate gave an empty result, the hidden query may not be monotonic')
+
+        logger.info(f'Finishing Correlated Sampler with a {succeeded_percent:.4g}% sample.')
         return True
 
     logger.info("Starting Correlated Sampler.")
 
-    sample_size_percent = INITIAL_SAMPLE_SIZE_PERCENT 
-    attempts_left = MAX_SAMPLING_ATTEMPTS
-    while attempts_left > 0:
-        logger.info(f'Starting sampling attempt {MAX_SAMPLING_ATTEMPTS - attempts_left}')
-        success = sample(sample_size_percent, ctx.db_relation_sizes)
-        if not success:
-            logger.warning(f'Sampling attempt {MAX_SAMPLING_ATTEMPTS - attempts_left} failed.')
-            sample_size_percent *= SAMPLE_SIZE_MULTIPLIER
-            attempts_left -= 1
+    if ctx.sampling_seed is None:
+        ctx.sampling_seed = random.randint(0, 2 ** 31 - 1)
+    logger.info(f'Sampling with {ctx.sampling_method}, seed {ctx.sampling_seed}')
+
+    # A repeatable sample at a lower rate is a subset of the one at a higher
+    # rate, so adding the rows of a higher rate to a sample gives the same
+    # instance as sampling at that rate directly. The sizes must not change
+    # until the end, as they decide the base tables.
+    executor = None
+    key_schema = None
+    if ctx.sampler_workers > 0 and len(key_list_groups(ctx)) > 1:
+        res, _ = ctx.connection.sql('SELECT pg_backend_pid();', fetch_one=True)
+        key_schema = f'{KEY_TABLE_SCHEMA_PREFIX}_{res[0]}'
+        ctx.connection.sql(f'DROP SCHEMA IF EXISTS {key_schema} CASCADE;', execute_only=True)
+        ctx.connection.sql(f'CREATE SCHEMA {key_schema};', execute_only=True)
+        executor = ProbeExecutor(ctx.connection, ctx.sampler_workers, shared_schema=key_schema)
+        logger.debug(f'Sampling the key list groups {key_list_groups(ctx)} on {ctx.sampler_workers} sessions')
+
+    ctx.connection.sql('BEGIN TRANSACTION;', execute_only=True)
+    create_key_tables(ctx, schema=key_schema)
+    if executor is not None:
+        # The other sessions only see committed tables
+        ctx.connection.sql('COMMIT;', execute_only=True)
+        executor.start()
+    try:
+        success = search()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if key_schema is None:
+        drop_key_tables(ctx)
+    else:
+        ctx.connection.sql(f'DROP SCHEMA {key_schema} CASCADE;', execute_only=True)
+    if success:
+        update_sizes()
+    ctx.connection.sql('COMMIT;', execute_only=True)
+    return success
+
+def stripe_condition(pages: int, stripe: int, stripes: int) -> str:
+    """Condition on the rows of a table of `pages` pages that are in the stripe, which the planner runs as a TID range scan"""
+    first_page, last_page = pages * stripe // stripes, pages * (stripe + 1) // stripes
+    if first_page == last_page:
+        return 'false'
+    return f"r.ctid >= '({first_page},0)'::tid AND r.ctid < '({last_page},0)'::tid"
+
+def progressive_sampler(ctx: UnmasqueContext) -> bool:
+    """
+        Adds stripes of the base tables, with the rows of the other core
+        relations joining with them, until the hidden query has a result.
+        This stops at the first stripe that gives a result instead of at a
+        sampling rate, and checks the hidden query after every stripe.
+    """
+    if ctx.core_relations is None:
+        raise RuntimeError("Cannot do sampling without extraction of metadata")
+
+    logger.info("Starting Progressive Sampler.")
+    if ctx.sampling_seed is None:
+        ctx.sampling_seed = random.randint(0, 2 ** 31 - 1)
+    logger.info(f'Sampling stripes in the order of seed {ctx.sampling_seed}')
+
+    # Without key lists, every table is sampled on its own
+    if len(ctx.key_lists) > 0:
+        base_tables = list(dict.fromkeys(key_list[get_base_t(key_list, ctx.db_relation_sizes)][0] for key_list in ctx.key_lists))
+        base_tables = [table for table in base_tables if table in ctx.core_relations]
+    else:
+        base_tables = ctx.core_relations
+
+    pages: Dict[str, int] = dict()
+    for table in base_tables:
+        res, _ = ctx.connection.sql(f"SELECT pg_relation_size('{table}_restore') / current_setting('block_size')::int;", fetch_one=True)
+        pages[table] = res[0]
+    stripes = max(1, min(PROGRESSIVE_STRIPES, max(pages.values(), default=1)))
+    stripe_order = list(range(stripes))
+    random.Random(ctx.sampling_seed).shuffle(stripe_order)
+
+    ctx.connection.sql('BEGIN TRANSACTION;', execute_only=True)
+    create_key_tables(ctx)
+
+    sampling_time = 0
+    probe_time = 0
+    success = False
+    for probes, stripe in enumerate(stripe_order, start=1):
+        base_conditions = {table: stripe_condition(pages[table], stripe, stripes) for table in base_tables}
+        if all(condition == 'false' for condition in base_conditions.values()) and probes > 1:
+            continue
+
+        start_time = time.time()
+        if len(ctx.key_lists) > 0:
+            sample_key_lists(ctx, 0, ctx.db_relation_sizes, base_conditions=base_conditions)
         else:
-            logger.info("Finishing Correlated Sampler.")
-            return True
+            ctx.connection.sql(' '.join(f'INSERT INTO {table} SELECT * FROM {table}_restore AS r WHERE {base_conditions[table]};' for table in base_tables), execute_only=True)
+        sampling_time += time.time() - start_time
+
+        start_time = time.time()
+        success = not ctx.connection.is_empty(ctx.hidden_query)
+        probe_time += time.time() - start_time
+        if success:
+            break
 
-    logger.error(f'Failed correlated sampling completely. Instead using the whole DB. All subsequent stages may be slow.')
-    for table in ctx.core_relations:
-        ctx.connection.sql(f'INSERT INTO {table} SELECT * FROM {table}_restore;',execute_only=True)
-    return False
+    drop_key_tables(ctx)
+    ctx.connection.sql('COMMIT;', execute_only=True)
 
+    sample_sizes = {table: ctx.connection.row_count(f'SELECT 1 FROM {table};') for table in ctx.core_relations}
+    logger.info(f'Sampled {probes} of {stripes} stripes: {sample_sizes}, '
+                f'sampling {round(sampling_time, 3)} s, probes {round(probe_time, 3)} s')
+    if not success:
+        logger.error(f'Failed progressive sampling completely. Instead using the whole DB. All subsequent stages may be slow.')
+        for table in ctx.core_relations:
+            ctx.connection.sql(f'DELETE FROM {table};', execute_only=True)
+            ctx.connection.sql(f'INSERT INTO {table} SELECT * FROM {table}_restore;',execute_only=True)
+        return False
 
+    ctx.db_relation_sizes.update(sample_sizes)
+    logger.info(f'Finishing Progressive Sampler with {probes} stripes.')
+    return True
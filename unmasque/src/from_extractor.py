@@ -1,29 +1,91 @@
+import time
+from typing import Dict, List
 from loguru import logger
 from .context import UnmasqueContext
+from .probe_executor import Probe, ProbeExecutor
 
 def from_extractor(ctx: UnmasqueContext):
     logger.info('Starting From Clause Extractor')
+    probes = 0
+
+    def empty_relations(tables: List[str]):
+        mutations = []
+        for table_name in tables:
+            mutations.append((f'ALTER TABLE {table_name} RENAME TO {table_name}_tmp;', ()))
+            mutations.append((f'CREATE TABLE {table_name} (LIKE {table_name}_tmp);', ()))
+        return mutations
+
+    def result_empty_without(tables: List[str]):
+        nonlocal probes
+        probes += 1
+        return ctx.connection.probe(ctx.hidden_query, empty_relations(tables))
+
     def relation_is_core_relation(table_name: str):
-        ctx.connection.sql('BEGIN TRANSACTION;', execute_only=True)
-        ctx.connection.sql(f'ALTER TABLE {table_name} RENAME TO {table_name}_tmp;', execute_only=True)
-        ctx.connection.sql(f'CREATE TABLE {table_name} (LIKE {table_name}_tmp);', execute_only=True)
-        res, _ = ctx.connection.sql(ctx.hidden_query)
-        ctx.connection.sql('ROLLBACK TRANSACTION;', execute_only=True)
+        start_time = time.time()
+        result = result_empty_without([table_name])
+        probe_latency[table_name] = time.time() - start_time
+        return result
+
+    def shadow_relation(table_name: str):
+        # A temporary table takes precedence over the real one on the search
+        # path, and creating it only needs a shared lock on the real table,
+        # so checks on different sessions do not block each other.
+        return [(f'CREATE TEMPORARY TABLE {table_name} (LIKE {ctx.connection.schema}.{table_name});', ())]
+
+    def find_core_relations_parallel(tables: List[str]) -> List[str]:
+        nonlocal probes
+        if ctx.probe_workers <= 0:
+            logger.error('Parallel from clause extraction needs at least one probe worker')
+            raise RuntimeError('Parallel from clause extraction needs at least one probe worker')
 
-        return len(res) == 0
+        table_probes = [Probe(ctx.hidden_query, shadow_relation(table)) for table in tables]
+        with ProbeExecutor(ctx.connection, ctx.probe_workers) as executor:
+            results = executor.map(table_probes)
+        probes += len(table_probes)
+
+        for table, probe in zip(tables, table_probes):
+            probe_latency[table] = probe.elapsed
+        return [table for table, result_empty in zip(tables, results) if result_empty]
+
+    def find_core_relations(tables: List[str], known_empty: bool = False) -> List[str]:
+        """
+            Group testing: the result can only become empty when at least one
+            of the emptied tables is a core relation, so a set that leaves the
+            result non-empty is discarded as a whole, and only the sets that
+            empty it are bisected.
+        """
+        if not known_empty and not result_empty_without(tables):
+            return []
+        if len(tables) == 1:
+            return tables
+
+        mid = len(tables) // 2
+        core_left = find_core_relations(tables[:mid])
+        # If the left half has no core relation, the right half must have one
+        return core_left + find_core_relations(tables[mid:], known_empty=len(core_left) == 0)
 
     core_relations = []
+    probe_latency: Dict[str, float] = dict()
 
     if ctx.db_relations is None:
         logger.error('Cannot proceed without having information about tables in the database')
         raise RuntimeError('Cannot proceed without having information about tables in the database')
 
-    for table in ctx.db_relations:
-        if relation_is_core_relation(table):
-            core_relations.append(table)
+    if ctx.from_extractor_strategy == 'group':
+        core_relations = find_core_relations(list(ctx.db_relations))
+    elif ctx.from_extractor_strategy == 'parallel':
+        core_relations = find_core_relations_parallel(list(ctx.db_relations))
+    elif ctx.from_extractor_strategy == 'linear':
+        for table in ctx.db_relations:
+            if relation_is_core_relation(table):
+                core_relations.append(table)
+    else:
+        logger.error(f'Unknown from clause extraction strategy {ctx.from_extractor_strategy}')
+        raise RuntimeError(f'Unknown from clause extraction strategy {ctx.from_extractor_strategy}')
 
-    logger.debug(f'Extracted core relations {core_relations}')
-    ctx.set_from_extractor(core_relations)
+    logger.debug(f'Extracted core relations {core_relations} using {probes} probes ({ctx.from_extractor_strategy})')
+    for table, latency in sorted(probe_latency.items(), key=lambda item: item[1], reverse=True):
+        logger.debug(f'Probe latency for {table}: {round(latency * 1000, 1)} ms')
+    ctx.set_from_extractor(core_relations, probe_latency)
 
     logger.info('Finishing From Clause Extractor')
-
@@ -18,39 +18,26 @@ def add_to_value(key_type: str, value, delta):
     return 'a'
 
 def groupby_extractor(ctx: UnmasqueContext):
-    def has_two_rows() -> bool:
-        res, _ = ctx.connection.sql(ctx.hidden_query)
-        return len(res) == 2
-
-    def begin_transaction():
-        ctx.connection.sql('BEGIN TRANSACTION;', execute_only=True)
-
-    def rollback():
-        ctx.connection.sql('ROLLBACK;', execute_only=True)
-
     def add_duplicate_rows_new_vals(table: str, attrib: str, value: Any):
-        if type(value) is not int:
-            value = f"'{value}'"
-        ctx.connection.sql(f'CREATE TABLE {table}_tmp AS SELECT * FROM {table};', execute_only=True)
-        ctx.connection.sql(f'UPDATE {table}_tmp SET {attrib}={value};', execute_only=True)
-        ctx.connection.sql(f'INSERT INTO {table} SELECT * FROM {table}_tmp;', execute_only=True)
-        ctx.connection.sql(f'DROP TABLE {table}_tmp;', execute_only=True)
+        return [
+            (f'CREATE TABLE {table}_tmp AS SELECT * FROM {table};', ()),
+            (f'UPDATE {table}_tmp SET {attrib} = $1;', (value,)),
+            (f'INSERT INTO {table} SELECT * FROM {table}_tmp;', ()),
+            (f'DROP TABLE {table}_tmp;', ()),
+        ]
 
     def get_attrib_value(table: str, attrib: str):
         res, _ = ctx.connection.sql(f'SELECT DISTINCT({attrib}) FROM {table};', fetch_one=True)
         return res[0]
 
     def is_groupby_attrib_with_val(table: str, attrib: str, val: Any) -> bool:
-        begin_transaction()
-        add_duplicate_rows_new_vals(table, attrib, val)
+        mutations = add_duplicate_rows_new_vals(table, attrib, val)
         for join in ctx.join_graph:
             if (table, attrib) in join:
                 for table_attrib in join:
                     if table_attrib != (table, attrib):
-                        add_duplicate_rows_new_vals(table_attrib[0], table_attrib[1], val)
-        is_empty = has_two_rows()
-        rollback()
-        return is_empty
+                        mutations.extend(add_duplicate_rows_new_vals(table_attrib[0], table_attrib[1], val))
+        return ctx.connection.probe(ctx.hidden_query, mutations, mode='count') == 2
 
     if ctx.core_relations is None:
         raise RuntimeError('Cannot run without metadata extraction and from clause extraction')
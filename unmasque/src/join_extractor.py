@@ -3,6 +3,7 @@ import datetime
 from typing import List, Tuple
 from loguru import logger
 from .context import UnmasqueContext
+from .probe_executor import Probe
 
 # Constants
 DUMMY_INTS = [2, 3]
@@ -49,24 +50,13 @@ def join_extractor(ctx: UnmasqueContext):
         key = key_list[0]
         return ctx.db_attribs_types[key[0]][key[1]]
 
-    def begin_transaction():
-        ctx.connection.sql('BEGIN TRANSACTION;', execute_only=True)
-
-    def rollback():
-        ctx.connection.sql('ROLLBACK;', execute_only=True)
-
-    def is_result_empty() -> bool:
-        res, _ = ctx.connection.sql(ctx.hidden_query)
-        return len(res) == 0
-
     def assign_value(key_list, value):
-        if type(value) is not int:
-            value = f"'{value}'"
-
+        mutations = []
         for table_attrib in key_list:
             table = table_attrib[0]
             attrib = table_attrib[1]
-            ctx.connection.sql(f"UPDATE {table} SET {attrib} = {value};", execute_only=True)
+            mutations.append((f"UPDATE {table} SET {attrib} = $1;", (value,)))
+        return mutations
 
     if ctx.core_relations is None:
         raise RuntimeError('Cannot run without metadata extraction and from clause extraction')
@@ -89,18 +79,28 @@ def join_extractor(ctx: UnmasqueContext):
             continue
         logger.debug(f'Checking join condition in the clique {key_list}')
 
+        partitions = [make_partition(key_list, partition_indicies) for partition_indicies in partition_combos[len(key_list)]]
+        key_type = get_type(key_list)
+        val1, val2 = get_pair_vals(key_type)
+
+        if ctx.probe_executor is not None:
+            # All the partitions of the clique are independent probes, run them
+            # together and take the first one (in the serial order) that splits
+            results = ctx.probe_executor.map(
+                Probe(ctx.hidden_query, assign_value(key_list1, val1) + assign_value(key_list2, val2))
+                for key_list1, key_list2 in partitions
+            )
+        else:
+            results = None
+
         partitoned = False
-        for partition_indicies in partition_combos[len(key_list)]:
-            key_list1, key_list2 = make_partition(key_list, partition_indicies)
-            key_type = get_type(key_list)
+        for i, (key_list1, key_list2) in enumerate(partitions):
             logger.debug(f'key_list1: {key_list1}, key_list2: {key_list2}, type: {key_type}')
-            val1, val2 = get_pair_vals(key_type)
 
-            begin_transaction()
-            assign_value(key_list1, val1)
-            assign_value(key_list2, val2)
-            result_empty = is_result_empty()
-            rollback()
+            if results is not None:
+                result_empty = results[i]
+            else:
+                result_empty = ctx.connection.probe(ctx.hidden_query, assign_value(key_list1, val1) + assign_value(key_list2, val2))
 
             if not result_empty:
                 # The edges joining key_list1 and key_list2 are not in the join
@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+from typing import Any, Dict
+from loguru import logger
+from .context import UnmasqueContext
+
+METADATA_CACHE_FILE = 'metadata.json'
+
+# Changes whenever a table is created, dropped, renamed, rewritten (e.g. by
+# TRUNCATE) or has rows inserted, updated or deleted, and whenever a column
+# or a constraint is added, dropped, renamed or changes type
+FINGERPRINT_QUERY = """
+    WITH tables AS (
+        SELECT c.oid, c.relname, c.relfilenode FROM pg_catalog.pg_class c
+            JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %(schema)s AND c.relkind IN ('r', 'p')
+    )
+    SELECT md5(concat_ws('|',
+        (SELECT string_agg(concat_ws(':', t.relname, t.relfilenode, s.n_tup_ins, s.n_tup_upd, s.n_tup_del), ',' ORDER BY t.relname)
+            FROM tables t LEFT JOIN pg_catalog.pg_stat_all_tables s ON s.relid = t.oid),
+        (SELECT string_agg(concat_ws(':', t.relname, a.attnum, a.attname, a.atttypid, a.atttypmod), ',' ORDER BY t.relname, a.attnum)
+            FROM tables t JOIN pg_catalog.pg_attribute a ON a.attrelid = t.oid
+            WHERE a.attnum > 0 AND NOT a.attisdropped),
+        (SELECT string_agg(concat_ws(':', t.relname, o.conname, o.contype, o.conkey, o.confrelid::regclass, o.confkey), ',' ORDER BY t.relname, o.conname)
+            FROM tables t JOIN pg_catalog.pg_constraint o ON o.conrelid = t.oid)
+    ));
+"""
+
+def catalog_fingerprint(ctx: UnmasqueContext) -> str:
+    """
+        Fingerprint of everything the metadata is extracted from: the catalog,
+        and the contents of the PK-FK file if there is one
+    """
+    res, _ = ctx.connection.sql(FINGERPRINT_QUERY, {'schema': ctx.connection.schema}, fetch_one=True)
+    if ctx.pkfk_csv_path is None:
+        return res[0]
+
+    with open(ctx.pkfk_csv_path, 'rb') as f:
+        return hashlib.md5(res[0].encode() + f.read()).hexdigest()
+
+def cache_key(ctx: UnmasqueContext) -> str:
+    return f'{ctx.connection.db_name}/{ctx.connection.schema}'
+
+def cache_path(ctx: UnmasqueContext) -> str:
+    assert ctx.cache_dir is not None
+    return os.path.join(ctx.cache_dir, METADATA_CACHE_FILE)
+
+def read_cache_file(ctx: UnmasqueContext) -> Dict[str, Any]:
+    path = cache_path(ctx)
+    if not os.path.exists(path):
+        return dict()
+
+    try:
+        with open(path, 'rt') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning(f'Ignoring unreadable metadata cache {path}: {e}')
+        return dict()
+
+def load_metadata(ctx: UnmasqueContext, fingerprint: str) -> Dict[str, Any] | None:
+    """
+        Returns the cached metadata of the database if it was stored under the
+        same fingerprint (which covers the PK-FK override), None otherwise
+    """
+    entry = read_cache_file(ctx).get(cache_key(ctx))
+    if entry is None or entry.get('fingerprint') != fingerprint:
+        return None
+
+    # JSON has no tuples
+    entry['key_lists'] = [[tuple(key) for key in key_list] for key_list in entry['key_lists']]
+    return entry
+
+def store_metadata(ctx: UnmasqueContext, entry: Dict[str, Any]):
+    path = cache_path(ctx)
+    cache = read_cache_file(ctx)
+    cache[cache_key(ctx)] = entry
+
+    os.makedirs(ctx.cache_dir, exist_ok=True)
+    # Write and rename, so that a concurrent run never sees a partial file
+    with open(path + '.tmp', 'wt') as f:
+        json.dump(cache, f)
+    os.replace(path + '.tmp', path)
+    logger.debug(f'Stored metadata in {path}')
@@ -1,82 +1,226 @@
 import csv
-from typing import Dict, List
+from typing import Any, Dict, List, Tuple
 from loguru import logger
 from .context import UnmasqueContext
+from .metadata_cache import catalog_fingerprint, load_metadata, store_metadata
+from .probe_executor import Probe, ProbeExecutor
+
+# Columns of all the given tables, with the type names information_schema would report
+COLUMNS_QUERY = """
+    SELECT c.relname, a.attname, format_type(a.atttypid, NULL), a.atttypmod, t.typname
+    FROM pg_catalog.pg_attribute a
+        JOIN pg_catalog.pg_class c ON c.oid = a.attrelid
+        JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_catalog.pg_type t ON t.oid = a.atttypid
+    WHERE n.nspname = %(schema)s AND c.relname = ANY(%(tables)s) AND a.attnum > 0 AND NOT a.attisdropped
+    ORDER BY c.relname, a.attnum;
+"""
+
+# One row per column of every primary key and (column pair of every) foreign key
+CONSTRAINTS_QUERY = """
+    SELECT c.contype, r.relname, a.attname, fr.relname, fa.attname
+    FROM pg_catalog.pg_constraint c
+        JOIN pg_catalog.pg_namespace n ON n.oid = c.connamespace
+        JOIN pg_catalog.pg_class r ON r.oid = c.conrelid
+        CROSS JOIN LATERAL unnest(c.conkey, c.confkey) WITH ORDINALITY AS k(attnum, fattnum, position)
+        JOIN pg_catalog.pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = k.attnum
+        LEFT JOIN pg_catalog.pg_class fr ON fr.oid = c.confrelid
+        LEFT JOIN pg_catalog.pg_attribute fa ON fa.attrelid = c.confrelid AND fa.attnum = k.fattnum
+    WHERE n.nspname = %(schema)s AND c.contype IN ('p', 'f')
+    ORDER BY r.oid, c.contype DESC, c.oid, k.position;
+"""
+
+# Planner statistics of the given tables, and their current size in pages
+SIZE_ESTIMATES_QUERY = """
+    SELECT c.relname, c.reltuples, c.relpages, pg_relation_size(c.oid) / current_setting('block_size')::int
+    FROM pg_catalog.pg_class c
+        JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = %(schema)s AND c.relname = ANY(%(tables)s);
+"""
+
+KeyAttrib = Tuple[str, str]
+
+class KeyClosure:
+    """
+        Union-find over (table, attribute) pairs, used to group the attributes
+        connected by PK-FK relationships into key lists.
+    """
+    def __init__(self):
+        self.parent: Dict[KeyAttrib, KeyAttrib] = dict()
+
+    def add(self, key: KeyAttrib):
+        if key not in self.parent:
+            self.parent[key] = key
+
+    def find(self, key: KeyAttrib) -> KeyAttrib:
+        self.add(key)
+        root = key
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # Path compression
+        while self.parent[key] != root:
+            self.parent[key], key = root, self.parent[key]
+        return root
+
+    def union(self, key1: KeyAttrib, key2: KeyAttrib):
+        root1, root2 = self.find(key1), self.find(key2)
+        if root1 != root2:
+            self.parent[root2] = root1
+
+    def groups(self) -> List[List[KeyAttrib]]:
+        groups: Dict[KeyAttrib, List[KeyAttrib]] = dict()
+        # Insertion order of the keys is kept within and across groups
+        for key in self.parent:
+            groups.setdefault(self.find(key), []).append(key)
+        return list(groups.values())
 
-# TODO: Deal with this
-SCHEMA_PATH = './pkfkrelations.csv'
 
 def get_tables(ctx: UnmasqueContext) -> List[str]:
     return ctx.connection.table_names()
 
-# TODO: Clean this up
-def get_pk_fk_graph(db_tables: List[str]):
-    all_pkfk = []
-    with open(SCHEMA_PATH, 'rt') as f:
+def get_table_sizes_exact(ctx: UnmasqueContext, tables: List[str]) -> Dict[str, int]:
+    if ctx.probe_workers <= 0:
+        return {table: ctx.connection.row_count(f'SELECT 1 FROM {table};') for table in tables}
+
+    count_probes = [Probe(f'SELECT 1 FROM {table};', mode='count') for table in tables]
+    with ProbeExecutor(ctx.connection, min(ctx.probe_workers, len(tables))) as executor:
+        counts = executor.map(count_probes)
+    return dict(zip(tables, counts))
+
+def get_table_sizes_estimate(ctx: UnmasqueContext, tables: List[str]) -> Dict[str, int]:
+    """
+        Estimates the sizes the way the planner does, scaling the tuple
+        density of the last ANALYZE (or VACUUM) to the current number of
+        pages. Tables that were never analyzed are counted.
+    """
+    if ctx.analyze_tables:
+        logger.debug('Analyzing tables in the database')
+        ctx.connection.sql(f'ANALYZE {", ".join(tables)};', execute_only=True)
+
+    res, _ = ctx.connection.sql(SIZE_ESTIMATES_QUERY, {'schema': ctx.connection.schema, 'tables': list(tables)})
+    if res is None:
+        logger.error('Failed to fetch the table statistics')
+        raise RuntimeError('Failed to fetch the table statistics')
+
+    db_table_sizes: Dict[str, int] = dict()
+    for table, reltuples, relpages, pages in res:
+        if relpages > 0 and reltuples >= 0:
+            db_table_sizes[table] = round(reltuples / relpages * pages)
+        elif pages == 0:
+            db_table_sizes[table] = 0
+
+    not_analyzed = [table for table in tables if table not in db_table_sizes]
+    if len(not_analyzed) > 0:
+        logger.warning(f'No statistics for {not_analyzed}, counting their rows instead')
+        db_table_sizes.update(get_table_sizes_exact(ctx, not_analyzed))
+
+    # Keep the order of the tables
+    return {table: db_table_sizes[table] for table in tables}
+
+def get_pk_fk_edges_from_catalog(ctx: UnmasqueContext):
+    res, _ = ctx.connection.sql(CONSTRAINTS_QUERY, {'schema': ctx.connection.schema})
+    if res is None:
+        logger.error('Failed to fetch the key constraints')
+        raise RuntimeError('Failed to fetch the key constraints')
+
+    pks: List[KeyAttrib] = []
+    fks: List[Tuple[KeyAttrib, KeyAttrib]] = []
+    for contype, table, attrib, ref_table, ref_attrib in res:
+        if contype == 'p':
+            pks.append((table, attrib))
+        else:
+            fks.append(((table, attrib), (ref_table, ref_attrib)))
+    return pks, fks
+
+def get_pk_fk_edges_from_csv(path: str):
+    with open(path, 'rt') as f:
         data = csv.reader(f)
         all_pkfk = list(data)[1:]
 
-    pk_dict = dict()
-    key_lists = [[]]
-    
-    temp = []
+    pks: List[KeyAttrib] = []
+    fks: List[Tuple[KeyAttrib, KeyAttrib]] = []
     for row in all_pkfk:
         if row[2].upper() == 'Y':
-            pk_dict[row[0]] = pk_dict.get(row[0], '') + ("," if row[0] in temp else '') + \
-                                          row[1]
-            temp.append(row[0])
-        found_flag = False
-        for elt in key_lists:
-            if (row[0], row[1]) in elt or (row[4], row[5]) in elt:
-                if (row[0], row[1]) not in elt and row[1]:
-                    elt.append((row[0], row[1]))
-                if (row[4], row[5]) not in elt and row[4]:
-                    elt.append((row[4], row[5]))
-                found_flag = True
-                break
-        if found_flag:
-            continue
-        if row[0] and row[4]:
-            key_lists.append([(row[0], row[1]), (row[4], row[5])])
-        elif row[0]:
-            key_lists.append([(row[0], row[1])])
-
-
-    key_lists = [list(filter(lambda val: val[0] in db_tables, elt)) for elt in
-                             key_lists if elt and len(elt) > 1]
+            pks.append((row[0], row[1]))
+        if row[4]:
+            fks.append(((row[0], row[1]), (row[4], row[5])))
+    return pks, fks
+
+def get_pk_fk_graph(db_tables: List[str], pks: List[KeyAttrib], fks: List[Tuple[KeyAttrib, KeyAttrib]]):
+    pk_dict: Dict[str, str] = dict()
+    for table, attrib in pks:
+        pk_dict[table] = pk_dict[table] + ',' + attrib if table in pk_dict else attrib
+
+    closure = KeyClosure()
+    for key in pks:
+        closure.add(key)
+    for key, ref_key in fks:
+        closure.union(key, ref_key)
+
+    db_tables_set = set(db_tables)
+    key_lists = [[key for key in group if key[0] in db_tables_set] for group in closure.groups() if len(group) > 1]
 
     return pk_dict, key_lists
 
-def get_attrib_types_and_maxlen(ctx: UnmasqueContext):
-    if ctx.core_relations is None:
-        return {}
+def get_attrib_types_and_maxlen(ctx: UnmasqueContext, tables: List[str]):
+    res, _ = ctx.connection.sql(COLUMNS_QUERY, {'schema': ctx.connection.schema, 'tables': list(tables)})
+    if res is None:
+        logger.error('Failed to fetch the attributes of the relations')
+        raise RuntimeError('Failed to fetch the attributes of the relations')
 
     db_attribs_types: Dict[str, Dict[str, str]] = dict()
     db_attribs_max_length: Dict[str, Dict[str, int]] = dict()
-    for table in ctx.core_relations:
-        res, _ = ctx.connection.sql(f"SELECT column_name, data_type, character_maximum_length FROM information_schema.columns WHERE table_schema='{ctx.connection.schema}' AND table_name='{table}';")
-        for row in res:
-            attrib = row[0]
-            attrib_type = row[1]
-            attrib_max_length = int(str(row[2])) if row[2] is not None else 0
-            
-            if db_attribs_types.get(table) is None:
-                db_attribs_types[table] = dict()
-
-            if db_attribs_max_length.get(table) is None:
-                db_attribs_max_length[table] = dict()
-
-            db_attribs_types[table][attrib] = attrib_type
-            db_attribs_max_length[table][attrib] = attrib_max_length
+    for table, attrib, attrib_type, typmod, typname in res:
+        # The type modifier of character types is the length plus the 4 byte header
+        attrib_max_length = typmod - 4 if typname in ('bpchar', 'varchar') and typmod > 0 else 0
+
+        db_attribs_types.setdefault(table, dict())[attrib] = attrib_type
+        db_attribs_max_length.setdefault(table, dict())[attrib] = attrib_max_length
 
     return db_attribs_types, db_attribs_max_length
-    
+
+
+def extract_metadata(ctx: UnmasqueContext, tables: List[str]) -> Dict[str, Any]:
+    logger.debug('Estimating sizes of tables in the database')
+    db_table_sizes = get_table_sizes_estimate(ctx, ctx.db_relations)
+
+    if ctx.pkfk_csv_path is not None:
+        logger.debug(f'Extracting primary keys and building PK-FK closure list from {ctx.pkfk_csv_path}')
+        pks, fks = get_pk_fk_edges_from_csv(ctx.pkfk_csv_path)
+    else:
+        logger.debug('Extracting primary keys and building PK-FK closure list from the catalog')
+        pks, fks = get_pk_fk_edges_from_catalog(ctx)
+    pk_dict, key_lists = get_pk_fk_graph(ctx.db_relations, pks, fks)
+
+    db_attribs_types, db_attribs_max_length = get_attrib_types_and_maxlen(ctx, tables)
+
+    return {
+        'db_relation_sizes': db_table_sizes,
+        'pk_dict': pk_dict,
+        'key_lists': key_lists,
+        'db_attribs_types': db_attribs_types,
+        'db_attribs_max_length': db_attribs_max_length,
+    }
+
+def only_core_relations(ctx: UnmasqueContext, attribs: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    assert ctx.core_relations is not None
+    return {table: attribs[table] for table in ctx.core_relations if table in attribs}
+
 
 def metadata_extractor_stage1(ctx: UnmasqueContext):
     logger.info('Starting Metadata extractor stage 1')
 
-    logger.debug('Fetching tables in the database')
-    db_tables = get_tables(ctx)
+    # Also tells the sampler whether the sample pyramid is up to date
+    ctx.metadata_fingerprint = catalog_fingerprint(ctx)
+    if ctx.cache_dir is not None:
+        ctx.cached_metadata = load_metadata(ctx, ctx.metadata_fingerprint)
+
+    if ctx.cached_metadata is not None:
+        logger.debug(f'Using cached metadata (fingerprint {ctx.metadata_fingerprint})')
+        db_tables = ctx.cached_metadata['db_relations']
+    else:
+        logger.debug('Fetching tables in the database')
+        db_tables = get_tables(ctx)
 
     ctx.set_metadata1(db_tables)
 
@@ -88,17 +232,29 @@ def metadata_extractor_stage2(ctx: UnmasqueContext):
     if ctx.core_relations is None or ctx.db_relations is None:
         raise RuntimeError('Cannot run stage 2 minimizer without running from clause extractor')
 
-    logger.debug('Fetching sizes of tables in the database')
-    db_table_sizes = dict()
-    for table in ctx.db_relations:
-        res, _ = ctx.connection.sql(f"SELECT COUNT(*) FROM {table};", fetch_one=True)
-        db_table_sizes[table] = res[0]
-
-    logger.debug('Extracting primary keys and building PK-FK closure list from schema file')
-    pk_dict, key_lists = get_pk_fk_graph(ctx.db_relations)
+    if ctx.cached_metadata is not None:
+        metadata = ctx.cached_metadata
+    elif ctx.cache_dir is not None:
+        # Cache the attributes of every table, the next query may use different ones
+        metadata = extract_metadata(ctx, ctx.db_relations)
+        store_metadata(ctx, {
+            'fingerprint': ctx.metadata_fingerprint,
+            'pkfk_csv_path': ctx.pkfk_csv_path,
+            'db_relations': ctx.db_relations,
+            **metadata,
+        })
+    else:
+        metadata = extract_metadata(ctx, ctx.core_relations)
 
-    db_attribs_types, db_attribs_max_length = get_attrib_types_and_maxlen(ctx)
+    db_table_sizes = dict(metadata['db_relation_sizes'])
+    if ctx.table_sizes == 'exact':
+        logger.debug('Counting rows of the core relations')
+        db_table_sizes.update(get_table_sizes_exact(ctx, ctx.core_relations))
 
-    ctx.set_metadata2(db_table_sizes, pk_dict, key_lists, db_attribs_types, db_attribs_max_length)
+    ctx.set_metadata2(
+        db_table_sizes, metadata['pk_dict'], metadata['key_lists'],
+        only_core_relations(ctx, metadata['db_attribs_types']),
+        only_core_relations(ctx, metadata['db_attribs_max_length']),
+    )
 
     logger.info('Finishing Metadata extractor stage 2')
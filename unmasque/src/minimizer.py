@@ -1,36 +1,105 @@
-from typing import Dict, List, Tuple
+import time
+from collections import Counter
+from itertools import islice
+from typing import Dict, Iterator, List, Set, Tuple
 from loguru import logger
+from .connection import probe_query, strip_query
 from .context import UnmasqueContext
+from .probe_executor import Probe, ProbeExecutor
 
 DEBUG_MINIMIZER = True
+FREQUENCY_PAGE_SIZE = 10     # Most frequent values fetched per attribute at a time
+PRUNE_EPSILON = 0.01                # Attributes whose best value keeps at least 1 - ε of the rows, or at most ε of them (or one row), are not tried
+LINEAR_PASS_DENSITY = 0.25          # Share of needed rows above which the row pass stops bisecting
 
-def minimizer(ctx: UnmasqueContext):
-    table_attributes_map: Dict[str, list[str]] = dict()
-    minimized_attributes: Dict[str, List[str]] = dict()
+# Server-side version of the row pass of the minimizer (see `minimize_rows`).
+# Each probe runs in a subtransaction (the EXCEPTION block), which is rolled
+# back by raising UM001 when the hidden query has no result.
+MINIMIZE_ROWS_FUNCTION = 'unmasque_minimize_rows'
+CREATE_MINIMIZE_ROWS_FUNCTION = """
+    CREATE OR REPLACE FUNCTION {schema}.{function}(target regclass, is_empty_query text, OUT survivors tid[], OUT probes integer) AS $$
+    DECLARE
+        all_rows tid[];
+        starts integer[];
+        ends integer[];
+        chunk_start integer;
+        chunk_end integer;
+        middle integer;
+        removed integer := 0;
+        is_empty boolean;
+    BEGIN
+        EXECUTE format('SELECT coalesce(array_agg(ctid), ''{{}}'') FROM %s', target) INTO all_rows;
+        survivors := '{{}}';
+        probes := 0;
+        IF cardinality(all_rows) < 2 THEN
+            survivors := all_rows;
+            RETURN;
+        END IF;
 
-    def begin_transaction():
-        ctx.connection.sql('BEGIN TRANSACTION;', execute_only=True)
+        -- Stack of the chunks still to try (end exclusive), depth first
+        starts := ARRAY[cardinality(all_rows) / 2 + 1, 1];
+        ends := ARRAY[cardinality(all_rows) + 1, cardinality(all_rows) / 2 + 1];
+        WHILE cardinality(starts) > 0 LOOP
+            chunk_start := starts[cardinality(starts)];
+            chunk_end := ends[cardinality(ends)];
+            starts := starts[1:cardinality(starts) - 1];
+            ends := ends[1:cardinality(ends) - 1];
+            probes := probes + 1;
+            BEGIN
+                EXECUTE format('DELETE FROM %s WHERE ctid = ANY($1)', target) USING all_rows[chunk_start:chunk_end - 1];
+                EXECUTE is_empty_query INTO is_empty;
+                IF is_empty THEN
+                    RAISE EXCEPTION USING ERRCODE = 'UM001';
+                END IF;
+                removed := removed + chunk_end - chunk_start;
+            EXCEPTION WHEN SQLSTATE 'UM001' THEN
+                IF chunk_end - chunk_start = 1 THEN
+                    survivors := survivors || all_rows[chunk_start];
+                ELSIF cardinality(survivors) > 0 AND cardinality(survivors) >= {linear_pass_density} * (cardinality(survivors) + removed) THEN
+                    FOR i IN REVERSE chunk_end - 1 .. chunk_start LOOP
+                        starts := starts || i;
+                        ends := ends || i + 1;
+                    END LOOP;
+                ELSE
+                    middle := (chunk_start + chunk_end) / 2;
+                    starts := starts || ARRAY[middle, chunk_start];
+                    ends := ends || ARRAY[chunk_end, middle];
+                END IF;
+            END;
+        END LOOP;
+    END;
+    $$ LANGUAGE plpgsql;
+"""
 
-    def commit_transaction():
-        ctx.connection.sql('COMMIT;', execute_only=True)
-
-    def rollback_transaction():
-        ctx.connection.sql('ROLLBACK;', execute_only=True)
+def key_list_tree(ctx: UnmasqueContext, root: str) -> List[Tuple[str, str, str, str]]:
+    """
+        Returns the core relations reachable from the root through the key
+        lists, as (Table, Key, Parent, Parent key) hops in breadth-first order
+    """
+    assert ctx.core_relations is not None
+    reached = {root}
+    hops = []
+    queue = [root]
+    while len(queue) > 0:
+        parent = queue.pop(0)
+        for key_list in ctx.key_lists:
+            parent_key = next((key for table, key in key_list if table == parent), None)
+            if parent_key is None:
+                continue
+            for child, child_key in key_list:
+                if child in ctx.core_relations and child not in reached:
+                    reached.add(child)
+                    hops.append((child, child_key, parent, parent_key))
+                    queue.append(child)
+    return hops
 
-    def empty_qurey_result() -> bool:
-        res, _ = ctx.connection.sql(ctx.hidden_query)
-        return len(res) == 0
+def minimizer(ctx: UnmasqueContext):
+    table_attributes_map: Dict[str, list[str]] = dict()
+    minimized_attributes: Dict[str, List[str]] = dict()
 
     def remove_all_rows_except_with_value(table, attribute, value):
-        if type(value) is not int:
-            value = f"'{value}'"
-        ctx.connection.sql(f"DELETE FROM {table} WHERE {attribute} != {value};", execute_only=True)
-        pass
-
-    def get_freq_value_of_attrib(table: str, attribute: str):
-        q = f"SELECT {attribute}, COUNT(*) FROM {table} GROUP BY {attribute};"
-        res, _ = ctx.connection.sql(q)
-        return res
+        # != would never hold for a NULL value (or a NULL row), and leave the rows in
+        return (f"DELETE FROM {table} WHERE {attribute} IS DISTINCT FROM $1;", (value,))
 
     def from_catalog_where():
         return f" FROM information_schema.columns WHERE table_schema = '{ctx.connection.schema}' and TABLE_CATALOG= '{ctx.connection.db_name}' "
@@ -51,79 +120,508 @@ def minimizer(ctx: UnmasqueContext):
         
         return table_attributes_map[table_name]
 
-    def get_frequency_of_values(table_name: str, except_in: List[str] = []) -> Dict[Tuple[str, str | int], int]:
-        """Returns a dictionary where the key is a tuple of the form (Attribute, Value) and the value is the frequency"""
+    def get_frequency_page(table_name: str, attributes: List[str], page: int) -> List[Tuple[str, str | int, int]]:
+        """
+            Returns the (Attribute, Value, Frequency) tuples ranked in the page
+            of the most frequent values of each of the attributes, most frequent
+            first. All the attributes are counted in a single scan of the table.
+        """
+        # GROUPING(attr) is 0 only in the grouping set of attr
+        attrib_index = ' '.join(f'WHEN GROUPING({attr}) = 0 THEN {i}' for i, attr in enumerate(attributes))
+        # The other attributes are NULL in the grouping set of an attribute, so
+        # ordering by all of them breaks ties between equally frequent values
+        # the same way on every run
+        values = ', '.join(attributes)
+        q = f"""
+            SELECT attrib_index, freq, {values} FROM (
+                SELECT CASE {attrib_index} END AS attrib_index, COUNT(*) AS freq, {values},
+                    row_number() OVER (PARTITION BY CASE {attrib_index} END ORDER BY COUNT(*) DESC, {values}) AS freq_rank
+                FROM {table_name} GROUP BY GROUPING SETS ({', '.join(f'({attr})' for attr in attributes)})
+            ) AS ranked
+            WHERE freq_rank > {page * FREQUENCY_PAGE_SIZE} AND freq_rank <= {(page + 1) * FREQUENCY_PAGE_SIZE}
+            ORDER BY freq DESC, attrib_index, {values};
+        """
+        res, _ = ctx.connection.sql(q)
+        return [(attributes[row[0]], row[2 + row[0]], row[1]) for row in res]
 
-        freq: Dict[Tuple[str, str | int], int] = dict()
+    def expected_rows_removed(freq: float, rows: int) -> float:
+        """Keeping only a value with relative frequency freq removes (1 - freq) of the rows"""
+        return (1 - freq) * rows
 
-        for attr in get_attributes(table_name):
-            if attr in except_in:
-                continue # we ignore this attribute
+    def worth_a_probe(freq: float, rows: int) -> bool:
+        """
+            Whether keeping only the best value of an attribute, of relative
+            frequency freq, is worth a probe. It is not if it removes almost no
+            row, nor if the attribute is (almost) unique, as keeping a single
+            row of the table is what the row pass does anyway.
+        """
+        kept = freq * rows
+        return max(1.0, PRUNE_EPSILON * rows) < kept < (1 - PRUNE_EPSILON) * rows
 
-            freq_vals = get_freq_value_of_attrib(table, attr)
-            for fv in freq_vals:
-                v, f = fv[0], fv[1]
-                freq[(attr, v)] = f
+    def get_attribute_stats(table_name: str, rows: int) -> Dict[str, float]:
+        """Returns the relative frequency of the most common value of each attribute, as estimated by ANALYZE"""
+        if table_name not in analyzed_tables:
+            ctx.connection.sql(f'ANALYZE {table_name};', execute_only=True)
+            analyzed_tables.add(table_name)
 
-        return freq
+        res, _ = ctx.connection.sql(f"SELECT attname, null_frac, n_distinct, most_common_freqs FROM pg_stats "
+                                    f"WHERE schemaname = '{ctx.connection.schema}' AND tablename = '{table_name}';")
+        best_freq: Dict[str, float] = dict()
+        for attr, null_frac, n_distinct, most_common_freqs in res:
+            # Negative n_distinct is the number of distinct values over the number of rows
+            distinct = n_distinct if n_distinct >= 0 else -n_distinct * rows
+            freq = null_frac
+            if most_common_freqs:
+                freq = max(freq, max(most_common_freqs))
+            elif distinct > 0:
+                freq = max(freq, (1 - null_frac) / distinct)
+            best_freq[attr] = freq
+        return best_freq
 
-    def get_frequency_sorted_attr_value(table_name: str, except_in: List[str] = []) -> Tuple[List[Tuple[str, str | int]], Dict[Tuple[str, str | int], int]]:
-        """Returns a list of (Attribute, Value) tuples that are sorted in the order of frequency"""
+    def get_table_rows(table_name: str) -> int:
+        # Only counted again once the table changed
+        if table_name not in table_rows:
+            table_rows[table_name] = ctx.connection.row_count(f'SELECT 1 FROM {table_name};')
+        return table_rows[table_name]
 
-        freq = get_frequency_of_values(table_name, except_in)
-        result = list(freq.keys())
-        result.sort(key=lambda x: freq[x], reverse=True)
+    def table_changed(table_name: str):
+        changed_tables.add(table_name)
+        analyzed_tables.discard(table_name)
+        table_rows.pop(table_name, None)
+
+    def get_pruned_attributes(table_name: str, except_in: List[str]) -> List[str]:
+        """Returns the attributes not worth a probe, judging by their most frequent value"""
+        nonlocal attribute_passes_pruned
+        rows = get_table_rows(table_name)
+        pruned = []
+        for attr, freq in get_attribute_stats(table_name, rows).items():
+            if attr in except_in or attr not in get_attributes(table_name):
+                continue
+            if not worth_a_probe(freq, rows):
+                pruned.append(attr)
+                attribute_passes_pruned += 1
+                pruned_attributes.setdefault(table_name, set()).add(attr)
+        return pruned
+
+    def get_single_valued_attributes(table_name: str) -> List[str]:
+        """Returns the attributes for which keeping only one value removes no row, hence can not make the result empty"""
+        attributes = get_attributes(table_name)
+        res, _ = ctx.connection.sql(f"SELECT {', '.join(f'COUNT(DISTINCT {attr}) <= 1' for attr in attributes)} FROM {table_name};", fetch_one=True)
+        return [attr for attr, single_valued in zip(attributes, res) if single_valued]
+
+    def get_frequency_sorted_attr_value(table_name: str, except_in: List[str] = []) -> Iterator[Tuple[str, str | int]]:
+        """
+            Yields (Attribute, Value) tuples in the order of the rows they are
+            expected to remove, a page of values per attribute at a time. The
+            next page is only fetched once the caller went through the current
+            one.
+        """
+        attributes = [attr for attr in get_attributes(table_name) if attr not in except_in]
+        rows = get_table_rows(table_name)
+        page = 0
+        while len(attributes) > 0:
+            freq_vals = get_frequency_page(table_name, attributes, page)
+            ranked = sorted(freq_vals, key=lambda fv: expected_rows_removed(fv[2] / rows, rows), reverse=True)
+            for attr, value, _ in ranked:
+                yield attr, value
 
-        return result, freq
+            # Only the attributes that filled the page have more values
+            counts = Counter(attr for attr, _, _ in freq_vals)
+            attributes = [attr for attr in attributes if counts[attr] == FREQUENCY_PAGE_SIZE]
+            page += 1
 
     def dbg_log(log: str):
         if DEBUG_MINIMIZER:
             logger.debug(log)
 
+    def result_nonempty_after(*mutations) -> bool:
+        """Keeps the mutations if the hidden query still has a result after them"""
+        nonlocal probes, probe_ms
+        probes += 1
+        start_time = time.time()
+        # if the result was empty, then the probe is rolled back!
+        is_empty = ctx.connection.probe(ctx.hidden_query, list(mutations))
+        probe_ms += (time.time() - start_time) * 1000
+        if is_empty:
+            return False
+        ctx.connection.commit_probe()
+        return True
+
+    def delete_rows(table: str, ctids: List[str]):
+        return (f'DELETE FROM {table} WHERE ctid = ANY($1::tid[]);', ('{' + ','.join(f'"{ctid}"' for ctid in ctids) + '}',))
+
+    def cascade_prune_sql(table_name: str) -> str | None:
+        """
+            Returns a statement deleting, in one go, the rows of the core
+            relations that can no longer join with the rows of the table,
+            following the key lists transitively. Each data-modifying CTE
+            returns the rows it deleted, so the next hop ignores them.
+        """
+        ctes = []
+        for child, child_key, parent, parent_key in key_list_tree(ctx, table_name):
+            remaining = f'SELECT 1 FROM {parent} WHERE {parent}.{parent_key} = {child}.{child_key}'
+            if parent != table_name:
+                remaining += f' AND {parent}.ctid NOT IN (SELECT ctid FROM pruned_{parent})'
+            ctes.append(f'pruned_{child} AS (DELETE FROM {child} WHERE NOT EXISTS ({remaining}) RETURNING {child}.ctid)')
+        if len(ctes) == 0:
+            return None
+        return f'WITH {", ".join(ctes)} SELECT 1;'
+
+    def get_shared_key_values(table_name: str) -> List[Tuple[List[Tuple[str, str]], str | int]]:
+        """
+            For each key list the table shares with other core relations,
+            returns the (Table, Key) clique and the most frequent key value of
+            the table that all of them have
+        """
+        assert ctx.core_relations is not None
+        candidates = []
+        for key_list in ctx.key_lists:
+            clique = [(table, key) for table, key in key_list if table in ctx.core_relations]
+            key = next((key for table, key in clique if table == table_name), None)
+            if key is None or len(clique) < 2:
+                continue
+
+            # NULL keys count as a value, as keeping the shared value removes their rows
+            union = ' UNION ALL '.join(f'SELECT {k} AS k FROM {t}' for t, k in clique)
+            res, _ = ctx.connection.sql(f'SELECT COUNT(DISTINCT k) + (COUNT(*) > COUNT(k))::int FROM ({union}) AS clique;', fetch_one=True)
+            if res[0] <= 1:
+                continue
+
+            # NULL keys never join, so the value is never NULL
+
+            shared = ' INTERSECT '.join(f'SELECT {k} FROM {t}' for t, k in clique if t != table_name)
+            res, _ = ctx.connection.sql(f'SELECT {key} FROM {table_name} WHERE {key} IN ({shared}) '
+                                        f'GROUP BY {key} ORDER BY COUNT(*) DESC LIMIT 1;', fetch_one=True)
+            if res is None:
+                continue
+            candidates.append((clique, res[0]))
+        return candidates
+
+    def co_minimize(table_name: str, with_cliques: bool = True) -> List[Tuple[str, Tuple]]:
+        """
+            After the table shrank, prunes the rows of the FK-linked tables
+            that no longer join and tries the key values shared by its cliques.
+            Returns the mutations that were kept.
+        """
+        kept = []
+        cascade = cascade_prune_sql(table_name)
+        if cascade is not None and result_nonempty_after((cascade, ())):
+            dbg_log(f'Pruned the rows that no longer join with {table_name}')
+            kept.append((cascade, ()))
+            for table in ctx.core_relations or []:
+                if table != table_name:
+                    table_changed(table)
+
+        for clique, value in (get_shared_key_values(table_name) if with_cliques else []):
+            mutations = [remove_all_rows_except_with_value(table, key, value) for table, key in clique]
+            if not result_nonempty_after(*mutations):
+                continue
+            dbg_log(f'Kept only {value} in {clique}')
+            kept.extend(mutations)
+            for table, key in clique:
+                table_changed(table)
+                if key not in minimized[table]:
+                    minimized[table].append(key)
+        return kept
+
+    def minimize_rows_on_server(table: str):
+        """Runs the row pass of the table in a single call of the server-side function"""
+        nonlocal probes, probe_ms
+        rows_before = ctx.connection.row_count(f'SELECT 1 FROM {table};')
+        start_time = time.time()
+        res, _ = ctx.connection.sql(f'SELECT survivors::text[], probes FROM {ctx.connection.schema}.{MINIMIZE_ROWS_FUNCTION}(%(table)s::regclass, %(query)s);',
+                                    {'table': table, 'query': strip_query(probe_query(ctx.hidden_query, 'empty'))}, fetch_one=True)
+        ctx.connection.sql('COMMIT;', execute_only=True)
+        probe_ms += (time.time() - start_time) * 1000
+        survivors, server_probes = res
+        dbg_log(f'Rows of {table} left: {survivors}')
+        probes += server_probes
+        return rows_before, len(survivors)
+
+    def explain_plan(query: str) -> Dict:
+        res, _ = ctx.connection.sql(f'EXPLAIN (FORMAT JSON) {strip_query(query)};', fetch_one=True)
+        return res[0][0]['Plan']
+
+    def get_best_freq(table_name: str) -> float:
+        """Relative frequency of the best value left to try on the table, as estimated by ANALYZE"""
+        rows = get_table_rows(table_name)
+        freqs = [freq for attr, freq in get_attribute_stats(table_name, rows).items()
+                 if attr in get_attributes(table_name) and attr not in minimized[table_name] and worth_a_probe(freq, rows)]
+        # Keeping all the rows removes none
+        return max(freqs, key=lambda freq: expected_rows_removed(freq, rows), default=1.0)
+
+    def get_probe_cost(table_name: str) -> float:
+        """
+            Estimated cost of a probe on the table: deleting from it, and
+            running the hidden query on the rows the best value keeps. The
+            planner is shown those rows by a temporary view shadowing the
+            table, limited to their number.
+        """
+        delete_cost = explain_plan(f'DELETE FROM {table_name}')['Total Cost']
+        kept_rows = max(1, round(get_best_freq(table_name) * get_table_rows(table_name)))
+        ctx.connection.sql(f'CREATE TEMPORARY VIEW {table_name} AS SELECT * FROM {ctx.connection.schema}.{table_name} LIMIT {kept_rows};', execute_only=True)
+        query_cost = explain_plan(ctx.hidden_query)['Total Cost']
+        ctx.connection.sql(f'DROP VIEW pg_temp.{table_name};', execute_only=True)
+        return delete_cost + query_cost
+
+    def get_expected_rows_removed(table_name: str) -> float:
+        """Rows the best value left to try on the table is expected to remove, as estimated by ANALYZE"""
+        return expected_rows_removed(get_best_freq(table_name), get_table_rows(table_name))
+
+    def schedule(tables: Set[str]) -> List[str]:
+        """
+            Returns the order to minimize the tables in: catalog order, or the
+            most rows expected to be removed per unit of estimated probe cost
+            first. The costs are estimated once per round, and reused to time
+            the probes of the round.
+        """
+        assert ctx.core_relations is not None
+        ordered = [table for table in ctx.core_relations if table in tables]
+        if ctx.minimizer_schedule != 'cost':
+            return ordered
+
+        probe_costs.clear()
+        probe_costs.update({table: get_probe_cost(table) for table in ordered})
+        gains = {table: get_expected_rows_removed(table) / probe_costs[table] for table in ordered}
+        ordered.sort(key=lambda table: gains[table], reverse=True)
+        dbg_log(f'Scheduled {ordered} by expected rows removed per unit of cost {gains}')
+        return ordered
+
+    def start_timing(table_name: str) -> Tuple[str, int, float, float]:
+        return table_name, probes, probe_ms, probe_costs.get(table_name, 0)
+
+    def stop_timing(timing: Tuple[str, int, float, float]):
+        """
+            Compares the time of the probes on the table to the one predicted
+            from their estimated cost, and calibrates the milliseconds per unit
+            of cost with it
+        """
+        nonlocal calibration_ms, calibration_cost
+        table_name, start_probes, start_probe_ms, probe_cost = timing
+        table_probes, elapsed = probes - start_probes, probe_ms - start_probe_ms
+        if ctx.minimizer_schedule != 'cost' or table_probes == 0:
+            return
+
+        predicted = table_probes * probe_cost * calibration_ms / calibration_cost if calibration_cost > 0 else None
+        dbg_log(f'{table_probes} probes on {table_name} of cost {round(probe_cost, 2)}: '
+                f'predicted {"-" if predicted is None else round(predicted, 2)} ms, took {round(elapsed, 2)} ms')
+        timings.setdefault(table_name, [0, 0, 0.0, 0.0])
+        timings[table_name][0] += table_probes
+        # The first probes only calibrate the predictions
+        if predicted is not None:
+            timings[table_name][1] += table_probes
+            timings[table_name][2] += predicted
+            timings[table_name][3] += elapsed
+        calibration_ms += elapsed
+        calibration_cost += table_probes * probe_cost
+
+    def minimize_rows(table: str):
+        """
+            Bisects the rows of the table: deletes a chunk of them, and splits
+            it in halves if the result becomes empty, down to single rows that
+            are needed for the hidden query to have a result. Rows of a chunk
+            that could be deleted are never tried again. Once needed rows are
+            dense, bisecting costs more probes than it saves, so the rows of
+            the chunks that cannot be deleted are tried one by one instead.
+        """
+        ctids, _ = ctx.connection.sql(f'SELECT ctid FROM {table};')
+        rows: List[str] = [ctid[0] for ctid in ctids]
+        if len(rows) < 2:
+            return len(rows), len(rows)
+
+        needed: List[str] = []
+        removed = 0
+        # Depth first, so the chunks are tried in the order of the rows
+        chunks = [(len(rows) // 2, len(rows)), (0, len(rows) // 2)]
+        while len(chunks) > 0:
+            start, end = chunks.pop()
+            if result_nonempty_after(delete_rows(table, rows[start:end])):
+                removed += end - start
+                continue
+            if end - start == 1:
+                needed.append(rows[start])
+            elif len(needed) > 0 and len(needed) >= LINEAR_PASS_DENSITY * (len(needed) + removed):
+                chunks.extend((i, i + 1) for i in reversed(range(start, end)))
+            else:
+                middle = (start + end) // 2
+                chunks.extend([(middle, end), (start, middle)])
+        return len(rows), len(needed)
+
     logger.info('Starting minimizer')
 
     if ctx.core_relations is None:
         raise RuntimeError('Cannot run minimizer without extracting metadata.')
     
-    is_minimized = False
+    probes = 0
+    probe_ms = 0.0
+    # Time taken by probes of a total estimated cost, for the predictions
+    calibration_ms = 0.0
+    calibration_cost = 0.0
+    timings: Dict[str, List] = dict()   # Table -> [probes, predicted probes, their predicted ms, their actual ms]
+    probe_costs: Dict[str, float] = dict()  # Estimated cost of a probe on each table scheduled this round
+    attribute_passes_pruned = 0     # Times the candidates of an attribute were skipped when going through a table
+    pruned_attributes: Dict[str, Set[str]] = dict()
+    known_failing_skipped = 0
+    analyzed_tables = set()
+    table_rows: Dict[str, int] = dict()
+    pruned: Dict[str, List[str]] = dict()
     minimized: Dict[str, List[str]] = dict()
+    # Candidates that made the result empty. The instance only shrinks, so
+    # they would make it empty again.
+    known_failing: Dict[str, Set[Tuple[str, str | int]]] = dict()
     for table in ctx.core_relations:
         minimized[table] = []
+        known_failing[table] = set()
+
+    def candidates(table_name: str) -> Iterator[Tuple[str, str | int]]:
+        """Yields the (Attribute, Value) candidates of the table that are worth a probe"""
+        nonlocal known_failing_skipped
+        dbg_log(f"[+] Minimizing table {table_name}")
+        pruned[table_name] = get_pruned_attributes(table_name, minimized[table_name])
+        for attrib, value in get_frequency_sorted_attr_value(table_name, minimized[table_name] + pruned[table_name]):
+            if (attrib, value) in known_failing[table_name]:
+                known_failing_skipped += 1
+                continue
+            yield attrib, value
+
+    def get_fk_components() -> List[Set[str]]:
+        """Groups the core relations connected through the key lists"""
+        assert ctx.core_relations is not None
+        components = [{table} for table in ctx.core_relations]
+        for key_list in ctx.key_lists:
+            tables = {table for table, _ in key_list}
+            connected = [component for component in components if component & tables]
+            if len(connected) > 1:
+                components = [component for component in components if not component & tables] + [set().union(*connected)]
+        return components
+
+    def keep_mutations(executor: ProbeExecutor, mutations):
+        """Commits mutations the probe sessions found to keep a result, and applies them to their copies too"""
+        for statement, params in mutations:
+            ctx.connection.prepared_sql(statement, params, execute_only=True)
+        ctx.connection.sql('COMMIT;', execute_only=True)
+        executor.broadcast(mutations)
+
+    def minimize_attributes_in_parallel(executor: ProbeExecutor):
+        """
+            Speculatively probes the next candidates of a table on all the
+            sessions at once and keeps the first success in rank order. Tables
+            of different FK components are minimized together, sharing the
+            sessions.
+        """
+        nonlocal probes
+        assert ctx.core_relations is not None
+        components = get_fk_components()
+        while len(changed_tables) > 0:
+            batch = []
+            order = schedule(changed_tables)
+            for component in components:
+                table = next((table for table in order if table in component), None)
+                if table is not None:
+                    batch.append(table)
+                    changed_tables.discard(table)
+
+            streams = {table: candidates(table) for table in batch}
+            while len(streams) > 0:
+                per_table = max(1, ctx.minimizer_workers // len(streams))
+                speculated = [(table, attrib, value) for table, stream in streams.items() for attrib, value in islice(stream, per_table)]
+                outcomes = executor.map([Probe(ctx.hidden_query, [remove_all_rows_except_with_value(table, attrib, value)])
+                                         for table, attrib, value in speculated])
+                probes += len(speculated)
+
+                successes: Dict[str, Tuple[str, str | int]] = dict()
+                for (table, attrib, value), is_empty in zip(speculated, outcomes):
+                    dbg_log(f'\t[*] Tried {table}.{attrib} = {value}: {"empty" if is_empty else "non-empty"}')
+                    if is_empty:
+                        known_failing[table].add((attrib, value))
+                    elif table not in successes:
+                        successes[table] = (attrib, value)
+
+                # Unrelated tables can still only keep a result on their own
+                chosen = list(successes.items())
+                if len(chosen) > 1:
+                    probes += 1
+                    if ctx.connection.probe(ctx.hidden_query, [remove_all_rows_except_with_value(table, attrib, value) for table, (attrib, value) in chosen]):
+                        chosen = chosen[:1]
+                if len(chosen) > 0:
+                    keep_mutations(executor, [remove_all_rows_except_with_value(table, attrib, value) for table, (attrib, value) in chosen])
+
+                for table, (attrib, value) in chosen:
+                    minimized[table].append(attrib)
+                    table_changed(table)
+                    if ctx.join_aware_minimizer:
+                        executor.broadcast(co_minimize(table))
+                for table in list(streams.keys()):
+                    # Tables with a success that was not kept are tried again next round
+                    if table in successes:
+                        changed_tables.add(table)
+                        del streams[table]
+                    elif sum(1 for t, _, _ in speculated if t == table) < per_table:
+                        del streams[table]
 
-    while not is_minimized:
-        for table in ctx.core_relations:
-            is_minimized = True
-            dbg_log(f"[+] Minimizing table {table}")
-            sorted_attrib_val, _ = get_frequency_sorted_attr_value(table, minimized[table])
+    # A table whose candidates all failed is only tried again once it changed
+    changed_tables = set(ctx.core_relations)
+    if ctx.minimizer_workers > 0:
+        # The sessions copy the committed instance
+        ctx.connection.sql('COMMIT;', execute_only=True)
+        with ProbeExecutor(ctx.connection, ctx.minimizer_workers, ctx.core_relations) as executor:
+            minimize_attributes_in_parallel(executor)
 
+    while len(changed_tables) > 0:
+        for table in schedule(changed_tables):
+            if table not in changed_tables:
+                continue
+            changed_tables.discard(table)
 
-            for attrib, value in sorted_attrib_val:
+            timing = start_timing(table)
+            for attrib, value in candidates(table):
                 dbg_log(f'\t[*] Trying {attrib} = {value}')
-                begin_transaction()
-                remove_all_rows_except_with_value(table, attrib, value)
 
-                # if the result was empty, then roll back!
-                if empty_qurey_result():
-                    rollback_transaction()
+                if not result_nonempty_after(remove_all_rows_except_with_value(table, attrib, value)):
+                    known_failing[table].add((attrib, value))
                     continue
                 
-                is_minimized = False
                 minimized[table].append(attrib)
-                commit_transaction()
+                table_changed(table)
+                if ctx.join_aware_minimizer:
+                    co_minimize(table)
                 break
+            stop_timing(timing)
+    logger.info(f'Minimized the attribute values with {probes} probes, {known_failing_skipped} known failing candidates skipped')
+    logger.info(f'Pruned {attribute_passes_pruned} attribute passes, of the attributes '
+                f'{ {table: sorted(attrs) for table, attrs in pruned_attributes.items()} }')
 
-    for table in ctx.core_relations:
-        ctids, _ = ctx.connection.sql(f'SELECT ctid FROM {table};')
-        for ctid in ctids:
-            begin_transaction()
-            ctx.connection.sql(f'DELETE FROM {table} WHERE ctid=\'{ctid[0]}\';', execute_only=True)
-            if empty_qurey_result():
-                rollback_transaction()
-                continue
-            commit_transaction()
+    if ctx.server_side_minimizer:
+        ctx.connection.sql(CREATE_MINIMIZE_ROWS_FUNCTION.format(schema=ctx.connection.schema, function=MINIMIZE_ROWS_FUNCTION,
+                                                                 linear_pass_density=LINEAR_PASS_DENSITY), None, execute_only=True)
+        ctx.connection.sql('COMMIT;', execute_only=True)
+
+    for table in schedule(set(ctx.core_relations)):
+        table_probes = probes
+        timing = start_timing(table)
+        rows_before, rows_after = minimize_rows_on_server(table) if ctx.server_side_minimizer else minimize_rows(table)
+        stop_timing(timing)
+        logger.info(f'Minimized {table} from {rows_before} to {rows_after} rows with {probes - table_probes} probes')
+        if ctx.join_aware_minimizer and rows_after < rows_before:
+            co_minimize(table, with_cliques=False)
+
+        # The attributes left with a single value would have been minimized by
+        # a probe that removes no row
+        minimized[table].extend(attr for attr in get_single_valued_attributes(table) if attr not in minimized[table])
+
+    if ctx.server_side_minimizer:
+        ctx.connection.sql(f'DROP FUNCTION {ctx.connection.schema}.{MINIMIZE_ROWS_FUNCTION};', execute_only=True)
+        ctx.connection.sql('COMMIT;', execute_only=True)
+
+    for table, (table_probes, predicted_probes, predicted, elapsed) in timings.items():
+        if predicted_probes == 0:
+            logger.info(f'{table_probes} probes on {table}, used for calibration')
+            continue
+        logger.info(f'{table_probes} probes on {table}, {predicted_probes} after calibration: predicted {round(predicted, 2)} ms, took {round(elapsed, 2)} ms')
 
     minimized_attributes = minimized
 
-    ctx.set_minimizer(table_attributes_map, minimized_attributes)
+    ctx.set_minimizer(table_attributes_map, minimized_attributes, probes)
+    logger.info(f'Minimizer used {probes} probes')
 
     logger.info('Finishing minimizer')
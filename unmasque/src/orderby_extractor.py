@@ -367,7 +367,7 @@ class OrderBy:
 
                     self.insert_attrib_vals_into_table(att_order, attrib_list_inner, insert_rows, tabname_inner)
 
-                new_result, _ = self.ctx.connection.sql(self.ctx.hidden_query)
+                new_result, _ = self.ctx.connection.prepared_sql(self.ctx.hidden_query)
                 self.joined_attrib_valDict.clear()
                 logger.debug("New Result", k, new_result)
                 if len(new_result) == 0:
@@ -9,12 +9,16 @@ from .projection_extractor import projection_extractor
 from .context import UnmasqueContext
 from .metadata_extractor import metadata_extractor_stage1, metadata_extractor_stage2
 from .from_extractor import from_extractor
-from .correlated_sampler import correlated_sampler
+from .correlated_sampler import correlated_sampler, progressive_sampler
+from .sample_pyramid import build_sample_pyramid, pyramid_sampler
+from .snapshot_cache import restore_snapshot, snapshot_keys, store_snapshot
 from .minimizer import minimizer
+from .constructive_minimizer import constructive_minimizer
 from .join_extractor import join_extractor
 from .groupby_extractor import groupby_extractor
 from .predicate_extractor import predicate_extractor
 from .limit_extractor import limit_extractor
+from .probe_executor import ProbeExecutor
 
 class Pipeline(ContextDecorator):
     def __init__(self, ctx: UnmasqueContext):
@@ -28,9 +32,13 @@ class Pipeline(ContextDecorator):
 
     def __exit__(self, *exc) -> bool:
         with logger.contextualize(pipeline='-x-', module='-x-'):
+            self.stop_probe_executor()
+
             logger.info('Restoring database back to its original state')
             self.restore_tables()
 
+            logger.info(f'Prepared statement cache: {self.ctx.connection.statement_cache_stats()}')
+
             logger.info('Closing database connection')
             self.ctx.connection.close()
         return False
@@ -59,6 +67,23 @@ class Pipeline(ContextDecorator):
 
         self.ctx.connection.sql("COMMIT;", execute_only=True)
 
+    def build_sample_pyramid(self):
+        with logger.contextualize(pipeline='-x-', module='Sample Pyramid'):
+            build_sample_pyramid(self.ctx)
+
+    def start_probe_executor(self):
+        """Provisions the probe sessions with private copies of the (committed) core relations"""
+        if self.ctx.probe_workers <= 0 or self.ctx.core_relations is None:
+            return
+
+        self.ctx.probe_executor = ProbeExecutor(self.ctx.connection, self.ctx.probe_workers, self.ctx.core_relations)
+        self.ctx.probe_executor.start()
+
+    def stop_probe_executor(self):
+        if self.ctx.probe_executor is not None:
+            self.ctx.probe_executor.shutdown()
+            self.ctx.probe_executor = None
+
 
     def run(self):
         with logger.contextualize(pipeline='Mutation'):
@@ -82,26 +107,52 @@ class Pipeline(ContextDecorator):
 
             start_time = time.time()
             self.backup_tables()
+            self.ctx.connection.sql('COMMIT;', execute_only=True)
             end_time = time.time()
             self.ctx.backup_time = end_time - start_time
 
-            with logger.contextualize(module='Correlated Sampler'):
-                start_time = time.time()
-                success = correlated_sampler(self.ctx)
-                end_time = time.time()
-                self.ctx.sampler_time = end_time - start_time
-                if not success:
-                    logger.warning('Correlated Sampling failed. Using initial database instead.')
-
-            with logger.contextualize(module='Minimizer'):
-                start_time = time.time()
-                minimizer(self.ctx)
-                end_time = time.time()
-                self.ctx.minimzer_time = end_time - start_time
+            snapshot_stage = None
+            if self.ctx.cache_snapshots:
+                with logger.contextualize(module='Snapshot Cache'):
+                    self.ctx.snapshot_keys = snapshot_keys(self.ctx)
+                    snapshot_stage = restore_snapshot(self.ctx)
+
+            if snapshot_stage is None:
+                with logger.contextualize(module='Correlated Sampler'):
+                    start_time = time.time()
+                    if self.ctx.sampling_strategy == 'progressive':
+                        success = progressive_sampler(self.ctx)
+                    elif self.ctx.sampling_strategy == 'pyramid':
+                        success = pyramid_sampler(self.ctx) or correlated_sampler(self.ctx)
+                    else:
+                        success = correlated_sampler(self.ctx)
+                    end_time = time.time()
+                    self.ctx.sampler_time = end_time - start_time
+                    if not success:
+                        logger.warning('Correlated Sampling failed. Using initial database instead.')
+
+                    # Not worth caching a copy of the whole database
+                    if self.ctx.cache_snapshots and success:
+                        store_snapshot(self.ctx, 'sampler')
+
+            if snapshot_stage != 'minimizer':
+                with logger.contextualize(module='Minimizer'):
+                    start_time = time.time()
+                    if self.ctx.minimizer_strategy == 'constructive' and not constructive_minimizer(self.ctx):
+                        logger.warning('No seed gave a result. Minimizing the whole sample instead.')
+                    minimizer(self.ctx)
+                    end_time = time.time()
+                    self.ctx.minimzer_time = end_time - start_time
+
+                    if self.ctx.cache_snapshots:
+                        store_snapshot(self.ctx, 'minimizer')
 
             with logger.contextualize(module='Join Graph Extractor'):
                 start_time = time.time()
+                self.start_probe_executor()
                 join_extractor(self.ctx)
+                # Later stages modify the minimized instance
+                self.stop_probe_executor()
                 end_time = time.time()
                 self.ctx.join_extractor_time = end_time - start_time
 
@@ -35,8 +35,7 @@ def predicate_extractor(ctx: UnmasqueContext):
         ctx.connection.sql('COMMIT;', execute_only=True)
 
     def is_result_empty() -> bool:
-        res, _ = ctx.connection.sql(ctx.hidden_query)
-        return len(res) == 0
+        return ctx.connection.is_empty(ctx.hidden_query)
 
     def get_attribs(table: str) -> list[str]:
         return ctx.table_attributes_map[table]
@@ -79,17 +78,12 @@ def predicate_extractor(ctx: UnmasqueContext):
         return res[0]
 
     def is_result_empty_with_attrib_value(table: str, attrib: str, value: Any, ctid = None):
-        if type(value) is not int:
-            value = f"'{value}'"
-        begin_transaction()
         if ctid is None:
-            ctx.connection.sql(f'UPDATE {table} SET {attrib} = {value};', execute_only=True)
+            mutation = (f'UPDATE {table} SET {attrib} = $1;', (value,))
         else:
-            ctx.connection.sql(f'UPDATE {table} SET {attrib} = {value} WHERE ctid = \'{ctid}\';', execute_only=True)
+            mutation = (f'UPDATE {table} SET {attrib} = $1 WHERE ctid = $2;', (value, ctid))
 
-        is_empty = is_result_empty()
-        rollback()
-        return is_empty
+        return ctx.connection.probe(ctx.hidden_query, [mutation])
 
     def binary_search(table: str, attrib: str, low, high, search_side: str, ctid = None):
         attrib_type = get_attrib_type(table, attrib)
@@ -245,17 +239,11 @@ def predicate_extractor(ctx: UnmasqueContext):
         for _, (ctid, val) in enumerate(ctid_vals):
             v = binary_search(table, attribute, min_val, val, 'l', ctid)
             if v == min_val:
-                v_fmted = v
-                if type(v) is not int:
-                    v_fmted = f"'{v}'"
-                ctx.connection.sql(f"UPDATE {table} SET {attribute} = {v_fmted} WHERE ctid='{ctid}';", execute_only=True)
+                ctx.connection.prepared_sql(f"UPDATE {table} SET {attribute} = $1 WHERE ctid = $2;", (v, ctid), execute_only=True)
                 v = None
                 continue
 
-            v_fmted = v
-            if type(v) is not int:
-                v_fmted = f"'{v}'"
-            ctx.connection.sql(f"UPDATE {table} SET {attribute} = {v_fmted} WHERE ctid='{ctid}';", execute_only=True)
+            ctx.connection.prepared_sql(f"UPDATE {table} SET {attribute} = $1 WHERE ctid = $2;", (v, ctid), execute_only=True)
             break
 
         commit()
@@ -286,11 +274,7 @@ def predicate_extractor(ctx: UnmasqueContext):
             ctid_vals = get_ctid_attrib_val(table, attribute, sorted=True)
             first_ctid, _ = ctid_vals[0]
 
-            lb_fmt = lb
-            if type(lb) is not int:
-                lb_fmt = f"'{lb}'"
-
-            ctx.connection.sql(f"UPDATE {table} SET {attribute}={lb_fmt} WHERE ctid='{first_ctid}';", execute_only=True)
+            ctx.connection.prepared_sql(f"UPDATE {table} SET {attribute} = $1 WHERE ctid = $2;", (lb, first_ctid), execute_only=True)
             was_empty = is_result_empty()
 
             rollback()
@@ -310,17 +294,11 @@ def predicate_extractor(ctx: UnmasqueContext):
             ctid, val = get_ctid_attrib_val(table, attribute, sorted=True)[i]
             v = binary_search(table, attribute, val, max_val, 'r', ctid)
             if v == max_val:
-                v_fmted = v
-                if type(v) is not int:
-                    v_fmted = f"'{v}'"
-                ctx.connection.sql(f"UPDATE {table} SET {attribute} = {v_fmted} WHERE ctid='{ctid}';", execute_only=True)
+                ctx.connection.prepared_sql(f"UPDATE {table} SET {attribute} = $1 WHERE ctid = $2;", (v, ctid), execute_only=True)
                 v = None
                 continue
 
-            v_fmted = v
-            if type(v) is not int:
-                v_fmted = f"'{v}'"
-            ctx.connection.sql(f"UPDATE {table} SET {attribute} = {v_fmted} WHERE ctid='{ctid}';", execute_only=True)
+            ctx.connection.prepared_sql(f"UPDATE {table} SET {attribute} = $1 WHERE ctid = $2;", (v, ctid), execute_only=True)
             break
 
         commit()
@@ -351,11 +329,7 @@ def predicate_extractor(ctx: UnmasqueContext):
             ctid_vals = get_ctid_attrib_val(table, attribute, sorted=True)
             first_ctid, _ = ctid_vals[0]
 
-            ub_fmt = ub
-            if type(ub) is not int:
-                ub_fmt = f"'{ub}'"
-
-            ctx.connection.sql(f"UPDATE {table} SET {attribute}={ub_fmt} WHERE ctid='{first_ctid}';", execute_only=True)
+            ctx.connection.prepared_sql(f"UPDATE {table} SET {attribute} = $1 WHERE ctid = $2;", (ub, first_ctid), execute_only=True)
             was_empty = is_result_empty()
 
             rollback()
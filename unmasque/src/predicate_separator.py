@@ -88,7 +88,7 @@ def predicate_separator(ctx: UnmasqueContext):
             r1, _ = ctx.connection.sql(join_only_query, fetch_one=True)
             gen_t2(sp_table, sp_attrib, b+1)
 
-            ground_truth, _ = ctx.connection.sql(ctx.hidden_query, fetch_one=True)
+            ground_truth = ctx.connection.first_row(ctx.hidden_query)
             if r1 == ground_truth:
                 sp_aggr = 'Filter'
                 new_having_pred = []
@@ -122,7 +122,7 @@ def predicate_separator(ctx: UnmasqueContext):
             gen_t1(sp_table, sp_attrib, a)
             r1, _ = ctx.connection.sql(join_only_query, fetch_one=True)
             gen_t2(sp_table, sp_attrib, a-1)
-            ground_truth, _ = ctx.connection.sql(ctx.hidden_query, fetch_one=True)
+            ground_truth = ctx.connection.first_row(ctx.hidden_query)
             if r1 == ground_truth:
                 sp_aggr = 'Filter'
                 new_having_pred = []
@@ -0,0 +1,199 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Iterable, List, Sequence, Tuple
+from loguru import logger
+
+from .connection import PROBE_MODE, IConnection, PostgresConnection
+
+# Suffixed with the backend pid of the session, so that the executors of
+# concurrent runs on the same database never share (or drop) a schema
+WORKER_SCHEMA_PREFIX = 'unmasque_worker'
+
+class Probe:
+    """
+        An independent experiment: the mutations are applied in a transaction
+        of their own, followed by the oracle check on `query`. The transaction
+        is always rolled back.
+    """
+    def __init__(self, query: str, mutations: Sequence[Tuple[str, Sequence[Any]]] = (), mode: PROBE_MODE = 'empty'):
+        self.query = query
+        self.mutations = mutations
+        self.mode: PROBE_MODE = mode
+
+        # Filled in by the executor
+        self.elapsed: float = 0
+
+
+class ProbeExecutor:
+    """
+        Runs independent probes concurrently on a pool of database sessions.
+
+        Each session can be given a private copy of `tables` in a schema of
+        its own that shadows the working schema on its search path, so that
+        probes running on different sessions never wait on each other's locks.
+        Without `tables`, the sessions see the working schema directly. The
+        tables of `shared_schema`, if given, are visible to all the sessions,
+        ahead of the working schema.
+
+        The sessions are handed out by an asyncio event loop running on a
+        background thread, and the (blocking) psycopg2 calls run on a thread
+        pool with one thread per session. `submit` and `map` can be called
+        from regular, synchronous code.
+
+        The main connection must have committed the state the copies are taken
+        from before the executor is started.
+    """
+    def __init__(self, connection: IConnection, workers: int, tables: List[str] | None = None, shared_schema: str | None = None):
+        self.connection = connection
+        self.workers = workers
+        self.tables = tables if tables is not None else []
+        self.shared_schema = shared_schema
+
+        self.sessions: List[PostgresConnection] = []
+        self.worker_schemas: List[str] = []
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.loop_thread: threading.Thread | None = None
+        self.threads: ThreadPoolExecutor | None = None
+        self.idle_sessions: asyncio.Queue | None = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        self.shutdown()
+        return False
+
+    def start(self):
+        logger.debug(f'Starting probe executor with {self.workers} sessions')
+        self.threads = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='unmasque-probe')
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, name='unmasque-probe-loop', daemon=True)
+        self.loop_thread.start()
+
+        self.sessions = [self._make_session() for _ in range(self.workers)]
+        if len(self.tables) > 0:
+            self.worker_schemas = [self._worker_schema(session) for session in self.sessions]
+        list(self.threads.map(self._provision, range(self.workers), self.sessions))
+
+        async def make_queue():
+            queue = asyncio.Queue()
+            for session in self.sessions:
+                queue.put_nowait(session)
+            return queue
+        self.idle_sessions = asyncio.run_coroutine_threadsafe(make_queue(), self.loop).result()
+
+    def shutdown(self):
+        if self.loop is None:
+            return
+
+        logger.debug('Shutting down probe executor')
+        assert self.threads is not None and self.loop_thread is not None
+        list(self.threads.map(self._unprovision, range(self.workers), self.sessions))
+        self.sessions = []
+        self.worker_schemas = []
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+        self.threads.shutdown()
+        self.loop = None
+
+    def submit(self, probe: Probe) -> Future:
+        """Schedules a probe and returns a future resolving to its outcome"""
+        if self.loop is None:
+            raise RuntimeError('Probe executor has not been started')
+        return asyncio.run_coroutine_threadsafe(self._run(self._probe_on, probe), self.loop)
+
+    def submit_transaction(self, statements: Sequence[str]) -> Future:
+        """Schedules statements to run and commit in a transaction of their own"""
+        if self.loop is None:
+            raise RuntimeError('Probe executor has not been started')
+        return asyncio.run_coroutine_threadsafe(self._run(self._commit_on, statements), self.loop)
+
+    def map(self, probes: Iterable[Probe]) -> List[Any]:
+        """Runs all the probes concurrently and returns their outcomes in order"""
+        futures = [self.submit(probe) for probe in probes]
+        return [future.result() for future in futures]
+
+    def broadcast(self, mutations: Sequence[Tuple[str, Sequence[Any]]]):
+        """
+            Applies and commits the mutations on every session, to keep their
+            copies of the tables in step with the main connection. No probe may
+            be running.
+        """
+        list(self.threads.map(self._apply, self.sessions, [mutations] * len(self.sessions)))
+
+    def refresh(self):
+        """Re-copies the tables from the working schema, after the main connection committed changes to them"""
+        list(self.threads.map(self._copy_tables, range(self.workers), self.sessions))
+
+    async def _run(self, job, *args):
+        """Runs `job(session, *args)` on the next idle session"""
+        assert self.idle_sessions is not None
+        session = await self.idle_sessions.get()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.threads, job, session, *args)
+        finally:
+            self.idle_sessions.put_nowait(session)
+
+    def _probe_on(self, session: PostgresConnection, probe: Probe):
+        start_time = time.time()
+        outcome = session.probe(probe.query, probe.mutations, probe.mode)
+        probe.elapsed = time.time() - start_time
+        return outcome
+
+    def _commit_on(self, session: PostgresConnection, statements: Sequence[str]):
+        if len(statements) > 0:
+            session.sql(' '.join(statements), execute_only=True)
+        session.sql('COMMIT;', execute_only=True)
+
+    def _apply(self, session: PostgresConnection, mutations: Sequence[Tuple[str, Sequence[Any]]]):
+        for statement, params in mutations:
+            session.prepared_sql(statement, params, execute_only=True)
+        session.sql('COMMIT;', execute_only=True)
+
+    def _make_session(self) -> PostgresConnection:
+        c = self.connection
+        session = PostgresConnection(db_name=c.db_name, schema=c.schema, host=c.host, port=c.port, user=c.user, password=c.password)
+        session.connect()
+        return session
+
+    def _worker_schema(self, session: PostgresConnection) -> str:
+        res, _ = session.sql('SELECT pg_backend_pid();', fetch_one=True)
+        return f'{WORKER_SCHEMA_PREFIX}_{res[0]}'
+
+    def _provision(self, worker: int, session: PostgresConnection):
+        search_path = [self.connection.schema]
+        if self.shared_schema is not None:
+            search_path.insert(0, self.shared_schema)
+        if len(self.tables) == 0:
+            if self.shared_schema is not None:
+                session.sql(f'SET search_path TO {", ".join(search_path)};', execute_only=True)
+                session.sql('COMMIT;', execute_only=True)
+            return
+
+        worker_schema = self.worker_schemas[worker]
+        session.sql(f'DROP SCHEMA IF EXISTS {worker_schema} CASCADE;', execute_only=True)
+        session.sql(f'CREATE SCHEMA {worker_schema};', execute_only=True)
+        for table in self.tables:
+            session.sql(f'CREATE TABLE {worker_schema}.{table} (LIKE {self.connection.schema}.{table});', execute_only=True)
+        session.sql(f'SET search_path TO {", ".join([worker_schema] + search_path)};', execute_only=True)
+        session.sql('COMMIT;', execute_only=True)
+        self._copy_tables(worker, session)
+
+    def _copy_tables(self, worker: int, session: PostgresConnection):
+        worker_schema = self.worker_schemas[worker]
+        for table in self.tables:
+            session.sql(f'TRUNCATE {worker_schema}.{table};', execute_only=True)
+            session.sql(f'INSERT INTO {worker_schema}.{table} SELECT * FROM {self.connection.schema}.{table};', execute_only=True)
+        session.sql('COMMIT;', execute_only=True)
+
+    def _unprovision(self, worker: int, session: PostgresConnection):
+        if len(self.tables) > 0:
+            session.sql('ROLLBACK;', execute_only=True)
+            session.sql(f'DROP SCHEMA IF EXISTS {self.worker_schemas[worker]} CASCADE;', execute_only=True)
+            session.sql('COMMIT;', execute_only=True)
+        session.close()
@@ -173,6 +173,9 @@ def round_expr(expr, num_digits):
     return expr.xreplace({n: round(n, num_digits) for n in expr.atoms(Rational) if not isinstance(n, Integer)})
 
 def projection_extractor(ctx: UnmasqueContext):
+    # Follows the seed of the sampler, so that a run can be reproduced
+    rng = random.Random(ctx.sampling_seed)
+
     # Utils
     def begin_transaction():
         ctx.connection.sql('BEGIN TRANSACTION;', execute_only=True)
@@ -394,7 +397,7 @@ def projection_extractor(ctx: UnmasqueContext):
         val, prev = update_attrib_to_see_impact(attrib, tabname)
         update_attribs_bulk(join_tabnames, other_attribs, val)
         # self.see_d_min()
-        new_result, _ = ctx.connection.sql(ctx.hidden_query)
+        new_result, _ = ctx.connection.prepared_sql(ctx.hidden_query)
         update_with_val(attrib, tabname, prev)
         update_attribs_bulk(join_tabnames, other_attribs, prev)
 
@@ -415,7 +418,7 @@ def projection_extractor(ctx: UnmasqueContext):
         if val == prev:
             logger.debug("Could not find other s-value! Cannot verify impact!")
             return
-        new_result, _ = ctx.connection.sql(ctx.hidden_query)
+        new_result, _ = ctx.connection.prepared_sql(ctx.hidden_query)
         update_with_val(attrib, tabname, prev)
         if len(new_result) != 0:
             projection_dep = get_index_of_difference(attrib, result, new_result, projection_dep, tabname)
@@ -427,7 +430,7 @@ def projection_extractor(ctx: UnmasqueContext):
     def find_projection_deps(query, s_values):
         # Get column names
         projection_names = []
-        result, desc = ctx.connection.sql(ctx.hidden_query)
+        result, desc = ctx.connection.prepared_sql(ctx.hidden_query)
         for col in desc:
             projection_names.append(col.name)
 
@@ -519,11 +522,11 @@ def projection_extractor(ctx: UnmasqueContext):
                     mini = get_boundary_value(lb, is_ub=False)
                     maxi = get_boundary_value(ub, is_ub=True)
                     if datatype == 'int':
-                        coeff[outer_idx][j] = random.randrange(mini, maxi)
+                        coeff[outer_idx][j] = rng.randrange(mini, maxi)
                     elif datatype == 'numeric':
-                        coeff[outer_idx][j] = round(random.uniform(float(mini), float(maxi)), 2)
+                        coeff[outer_idx][j] = round(rng.uniform(float(mini), float(maxi)), 2)
                 else:
-                    coeff[outer_idx][j] = random.randrange(math.floor(mini), math.ceil(maxi))
+                    coeff[outer_idx][j] = rng.randrange(math.floor(mini), math.ceil(maxi))
 
             temp_array = get_param_values_external(coeff[outer_idx][:n])
             for j in range(2 ** n - 1):
@@ -605,7 +608,7 @@ def projection_extractor(ctx: UnmasqueContext):
                 for j_c in joined_cols:
                     update_attrib_in_table(j_c[1], value, j_c[0])
 
-            exe_result, _ = ctx.connection.sql(ctx.hidden_query)
+            exe_result, _ = ctx.connection.prepared_sql(ctx.hidden_query)
             rollback()
             if not len(exe_result) == 0:
                 b[i][0] = exe_result[0][idx] # self.app.get_attrib_val(exe_result, idx)
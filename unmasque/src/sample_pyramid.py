@@ -0,0 +1,146 @@
+import copy
+import random
+import time
+from typing import List, Tuple
+from loguru import logger
+from .context import UnmasqueContext
+from .correlated_sampler import create_key_tables, drop_key_tables, sample_key_list_sql
+from .metadata_cache import catalog_fingerprint
+from .metadata_extractor import extract_metadata, get_tables
+
+# Side schema holding a sample of every relation of the database at each
+# level. The samples only depend on the PK-FK relationships, so they are built
+# once and shared by all the hidden queries on the database.
+PYRAMID_SCHEMA = 'unmasque_samples'
+PYRAMID_LEVELS = [0.1, 1, 10]
+
+LEVELS_TABLE = f'{PYRAMID_SCHEMA}.levels'
+CREATE_LEVELS_TABLE = f"""
+    CREATE TABLE {LEVELS_TABLE} (
+        percent double precision PRIMARY KEY,
+        method text NOT NULL,
+        seed integer NOT NULL,
+        fingerprint text NOT NULL,
+        built_at timestamptz NOT NULL DEFAULT now()
+    );
+"""
+
+PyramidLevel = Tuple[float, str, int]
+
+def level_table(table: str, percent: float) -> str:
+    # The levels are read back as floats, so 1 and 1.0 must give the same name
+    return f'{PYRAMID_SCHEMA}.{table}_{f"{percent:g}".replace(".", "_")}'
+
+def build_sample_pyramid(ctx: UnmasqueContext):
+    """
+        (Re-)builds the sample pyramid of the database, sampling every relation
+        the way the correlated sampler samples the core relations. The levels
+        are sampled with the same seed, so each is a subset of the next.
+    """
+    logger.info('Starting Sample Pyramid builder')
+
+    # Every relation is sampled, whatever the hidden query
+    build_ctx = copy.copy(ctx)
+    build_ctx.db_relations = get_tables(ctx)
+    metadata = extract_metadata(build_ctx, build_ctx.db_relations)
+    build_ctx.core_relations = build_ctx.db_relations
+    build_ctx.db_relation_sizes = metadata['db_relation_sizes']
+    build_ctx.key_lists = metadata['key_lists']
+    if build_ctx.sampling_seed is None:
+        build_ctx.sampling_seed = random.randint(0, 2 ** 31 - 1)
+
+    fingerprint = catalog_fingerprint(ctx)
+    schema = ctx.connection.schema
+    source = f'{schema}.{{table}}'
+    tables_in_key_lists = set(table for key_list in build_ctx.key_lists for table, _ in key_list)
+
+    ctx.connection.sql('BEGIN TRANSACTION;', execute_only=True)
+    ctx.connection.sql(f'DROP SCHEMA IF EXISTS {PYRAMID_SCHEMA} CASCADE;', execute_only=True)
+    ctx.connection.sql(f'CREATE SCHEMA {PYRAMID_SCHEMA};', execute_only=True)
+    ctx.connection.sql(CREATE_LEVELS_TABLE, execute_only=True)
+
+    for percent in PYRAMID_LEVELS:
+        start_time = time.time()
+        target = level_table('{table}', percent)
+        for table in build_ctx.db_relations:
+            ctx.connection.sql(f'CREATE TABLE {level_table(table, percent)} (LIKE {schema}.{table});', execute_only=True)
+
+        create_key_tables(build_ctx, target)
+        for i, key_list in enumerate(build_ctx.key_lists):
+            statements = sample_key_list_sql(build_ctx, i, key_list, percent, build_ctx.db_relation_sizes, target, source)
+            if len(statements) > 0:
+                ctx.connection.sql(' '.join(statements), execute_only=True)
+        drop_key_tables(build_ctx)
+
+        for table in build_ctx.db_relations:
+            if table not in tables_in_key_lists:
+                ctx.connection.sql(f'INSERT INTO {level_table(table, percent)} SELECT * FROM {schema}.{table} '
+                                   f'TABLESAMPLE {build_ctx.sampling_method}({percent}) REPEATABLE({build_ctx.sampling_seed});', execute_only=True)
+
+        ctx.connection.sql(f'INSERT INTO {LEVELS_TABLE} (percent, method, seed, fingerprint) VALUES (%(percent)s, %(method)s, %(seed)s, %(fingerprint)s);',
+                           {'percent': percent, 'method': build_ctx.sampling_method, 'seed': build_ctx.sampling_seed, 'fingerprint': fingerprint}, execute_only=True)
+        sizes = {table: ctx.connection.row_count(f'SELECT 1 FROM {level_table(table, percent)};') for table in build_ctx.db_relations}
+        logger.info(f'Built {percent}% level in {round(time.time() - start_time, 3)} s: {sizes}')
+
+    ctx.connection.sql('COMMIT;', execute_only=True)
+    logger.info(f'Finishing Sample Pyramid builder with {build_ctx.sampling_method}, seed {build_ctx.sampling_seed}')
+
+def get_pyramid_levels(ctx: UnmasqueContext) -> List[PyramidLevel]:
+    """Returns the levels of the sample pyramid, smallest first, if it was built from the current database"""
+    res, _ = ctx.connection.sql(f"SELECT to_regclass('{LEVELS_TABLE}') IS NOT NULL;", fetch_one=True)
+    if not res[0]:
+        logger.warning('There is no sample pyramid, build it with --build-sample-pyramid')
+        return []
+
+    res, _ = ctx.connection.sql(f'SELECT percent, method, seed, fingerprint FROM {LEVELS_TABLE} ORDER BY percent;')
+    if res is None:
+        return []
+
+    if any(fingerprint != ctx.metadata_fingerprint for _, _, _, fingerprint in res):
+        logger.warning('The database changed since the sample pyramid was built, rebuild it with --build-sample-pyramid')
+        return []
+    return [(percent, method, seed) for percent, method, seed, _ in res]
+
+def pyramid_sampler(ctx: UnmasqueContext) -> bool:
+    """
+        Fills the copies of the core relations with the smallest level of the
+        sample pyramid for which the hidden query has a result. Leaves them
+        empty and returns False if there is no such level.
+    """
+    if ctx.core_relations is None:
+        raise RuntimeError("Cannot do sampling without extraction of metadata")
+
+    logger.info('Starting Pyramid Sampler.')
+    levels = get_pyramid_levels(ctx)
+    if len(levels) == 0:
+        return False
+
+    ctx.connection.sql('BEGIN TRANSACTION;', execute_only=True)
+    for percent, method, seed in levels:
+        start_time = time.time()
+        for table in ctx.core_relations:
+            ctx.connection.sql(f'DELETE FROM {table};', execute_only=True)
+            ctx.connection.sql(f'INSERT INTO {table} SELECT * FROM {level_table(table, percent)};', execute_only=True)
+        sampling_time = time.time() - start_time
+
+        start_time = time.time()
+        success = not ctx.connection.is_empty(ctx.hidden_query)
+        probe_time = time.time() - start_time
+
+        sample_sizes = {table: ctx.connection.row_count(f'SELECT 1 FROM {table};') for table in ctx.core_relations}
+        logger.info(f'Level {percent}%: {sample_sizes}, '
+                    f'copying {round(sampling_time, 3)} s, probe {round(probe_time, 3)} s, '
+                    f'result {"non-empty" if success else "empty"}')
+        if not success:
+            continue
+
+        ctx.db_relation_sizes.update(sample_sizes)
+        # The level was sampled with the builder's method and seed, whatever the options say
+        ctx.pyramid_level = (percent, method, seed)
+        ctx.connection.sql('COMMIT;', execute_only=True)
+        logger.info(f'Finishing Pyramid Sampler with the {percent}% level, sampled with {method}, seed {seed}.')
+        return True
+
+    ctx.connection.sql('ROLLBACK;', execute_only=True)
+    logger.info('Finishing Pyramid Sampler without a level that gives a result.')
+    return False
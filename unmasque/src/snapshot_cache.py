@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+import shutil
+from typing import Any, Dict, Literal
+from loguru import logger
+from .context import UnmasqueContext
+
+SNAPSHOT_DIR = 'snapshots'
+SNAPSHOT_SIDECAR = 'snapshot.json'
+
+# Stages after which the contents of the core relations are saved, in
+# pipeline order
+SnapshotStage = Literal['sampler', 'minimizer']
+SNAPSHOT_STAGES = ['sampler', 'minimizer']
+
+def snapshot_key(ctx: UnmasqueContext, stage: SnapshotStage) -> str | None:
+    """
+        The sampled instance only depends on the hidden query, the database and
+        the sample drawn, the minimized one also on the options of the
+        minimizer
+    """
+    if ctx.sampling_seed is None or ctx.metadata_fingerprint is None:
+        return None
+
+    parts = [ctx.hidden_query.strip(), ctx.metadata_fingerprint, ctx.sampling_method, ctx.sampling_seed, ctx.sampling_strategy]
+    if stage == 'minimizer':
+        parts += [ctx.minimizer_strategy, ctx.join_aware_minimizer, ctx.server_side_minimizer, ctx.minimizer_schedule, ctx.minimizer_workers]
+    return hashlib.sha256('\0'.join(map(str, parts)).encode()).hexdigest()
+
+def snapshot_keys(ctx: UnmasqueContext) -> Dict[str, str]:
+    """The keys of the stages of this run. Taken before sampling, as the pyramid sampler does not use the seed."""
+    keys = {stage: snapshot_key(ctx, stage) for stage in SNAPSHOT_STAGES}
+    return {stage: key for stage, key in keys.items() if key is not None}
+
+def snapshot_path(ctx: UnmasqueContext, stage: SnapshotStage) -> str:
+    if ctx.cache_dir is None:
+        logger.error('Cannot cache snapshots without a cache directory')
+        raise RuntimeError('Cannot cache snapshots without a cache directory')
+
+    return os.path.join(ctx.cache_dir, SNAPSHOT_DIR, ctx.snapshot_keys[stage], stage)
+
+def table_file(path: str, table: str) -> str:
+    return os.path.join(path, f'{table}.bin')
+
+def store_snapshot(ctx: UnmasqueContext, stage: SnapshotStage):
+    """Saves the contents of the core relations, along with what the stage extracted"""
+    assert ctx.core_relations is not None
+    if stage not in ctx.snapshot_keys:
+        return
+
+    path = snapshot_path(ctx, stage)
+    sidecar: Dict[str, Any] = {
+        'stage': stage,
+        'hidden_query': ctx.hidden_query,
+        'fingerprint': ctx.metadata_fingerprint,
+        'sampling_method': ctx.sampling_method,
+        'sampling_seed': ctx.sampling_seed,
+        'pyramid_level': ctx.pyramid_level,
+        'core_relations': ctx.core_relations,
+        'db_relation_sizes': {table: ctx.db_relation_sizes[table] for table in ctx.core_relations},
+    }
+    if stage == 'minimizer':
+        sidecar['table_attributes_map'] = ctx.table_attributes_map
+        sidecar['minimized_attributes'] = ctx.minimized_attributes
+
+    # Write and rename, so that a concurrent run never sees a partial snapshot
+    shutil.rmtree(path + '.tmp', ignore_errors=True)
+    os.makedirs(path + '.tmp')
+    for table in ctx.core_relations:
+        with open(table_file(path + '.tmp', table), 'wb') as f:
+            ctx.connection.copy_to(table, f)
+    with open(os.path.join(path + '.tmp', SNAPSHOT_SIDECAR), 'wt') as f:
+        json.dump(sidecar, f)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(path + '.tmp', path)
+    logger.debug(f'Stored {stage} snapshot in {path}')
+
+def load_snapshot(ctx: UnmasqueContext, stage: SnapshotStage) -> Dict[str, Any] | None:
+    """Returns the sidecar of the snapshot taken after the stage, if there is one for this run"""
+    if stage not in ctx.snapshot_keys:
+        return None
+
+    path = os.path.join(snapshot_path(ctx, stage), SNAPSHOT_SIDECAR)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, 'rt') as f:
+            sidecar = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning(f'Ignoring unreadable snapshot {path}: {e}')
+        return None
+
+    # Guards against hash collisions
+    if sidecar.get('hidden_query') != ctx.hidden_query or sidecar.get('fingerprint') != ctx.metadata_fingerprint \
+            or sidecar.get('core_relations') != ctx.core_relations:
+        return None
+    return sidecar
+
+def restore_snapshot(ctx: UnmasqueContext) -> SnapshotStage | None:
+    """
+        Fills the (empty) copies of the core relations with the latest snapshot
+        of this run and sets what the stages before it extracted. Returns the
+        stage the snapshot was taken after, None if there is none.
+    """
+    assert ctx.core_relations is not None
+    if len(ctx.snapshot_keys) == 0:
+        logger.info('Snapshots are only reused with a fixed --seed')
+        return None
+
+    for stage in reversed(SNAPSHOT_STAGES):
+        sidecar = load_snapshot(ctx, stage)
+        if sidecar is None:
+            continue
+
+        path = snapshot_path(ctx, stage)
+        ctx.connection.sql('BEGIN TRANSACTION;', execute_only=True)
+        for table in ctx.core_relations:
+            with open(table_file(path, table), 'rb') as f:
+                ctx.connection.copy_from(table, f)
+        ctx.connection.sql('COMMIT;', execute_only=True)
+
+        ctx.db_relation_sizes.update(sidecar['db_relation_sizes'])
+        if sidecar.get('pyramid_level') is not None:
+            ctx.pyramid_level = tuple(sidecar['pyramid_level'])
+        if stage == 'minimizer':
+            ctx.set_minimizer(sidecar['table_attributes_map'], sidecar['minimized_attributes'])
+        logger.info(f'Restored the {stage} snapshot from {path}')
+        return stage
+
+    return None